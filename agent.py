@@ -1,114 +1,1133 @@
 import os
 import re
 import json
-from prompt import ALIGN_PROMPT_TEMPLATE, REVIEW_PROMPT_TEMPLATE, GENERATE_PROMPT_TEMPLATE
+import time
+import random
+import hashlib
+import atexit
+import threading
+import httpx
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from prompt import ALIGN_PROMPT_TEMPLATE, BATCH_ALIGN_PROMPT_TEMPLATE, SKELETON_ALIGN_PROMPT_TEMPLATE, REVIEW_PROMPT_TEMPLATE, REVIEW_REDUCE_PROMPT_TEMPLATE, GENERATE_PROMPT_TEMPLATE
+import openai
 from openai import OpenAI
+from openai.types.chat import ChatCompletionMessage
+from llm_cache import get_llm_cache, make_cache_key
+from code_index import BM25Index, ALIGN_TOP_K
+from utils import pack_code_files, pack_code_units, estimate_tokens, get_token_encoder, count_tokens_batch, numbered_line_tokens, build_code_skeleton, compact_code
+from llm_scheduler import AdaptiveLimiter, SingleFlight, LLM_LIMIT_MAX, llm_priority, current_llm_priority, map_in_context, submit_in_context, PRIORITY_BATCH
+from llm_metrics import get_llm_metrics, log_llm_call
+from llm_router import EndpointRouter, parse_base_urls, make_affinity_key, LLM_HEALTH_CHECK_TIMEOUT
 
+# 推理服务地址，多个副本以逗号分隔（如 http://gpu1:8001/v1,http://gpu2:8001/v1），请求在各副本之间负载均衡
 API_BASE_URL = os.environ.get("API_BASE_URL", "http://localhost:8001/v1")
+API_BASE_URLS = parse_base_urls(API_BASE_URL)
 API_KEY = os.environ.get("API_KEY", "0")
 MODEL_NAME = "/home/kwy/project/models/deepseek-coder-6.7b-instruct"
 
-def query_llm(message, history=None):
-    client = OpenAI(
-        api_key=API_KEY,
-        base_url=API_BASE_URL,
-    )
+# 连接池配置
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 64))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", 32))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 600))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", 10))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 2))
+LLM_RETRY_DELAY = float(os.environ.get("LLM_RETRY_DELAY", 0.5))  # 首次重试前的等待（秒），之后每次翻倍
+LLM_RETRY_MAX_DELAY = 8.0
+
+# 单个需求对齐时并发发送的代码块请求数（本地 vLLM 通常在 16~32 并发时吞吐最高）
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", 16))
+
+# 对齐时每个提示词中代码部分的 token 预算
+ALIGN_CHUNK_TOKENS = int(os.environ.get("ALIGN_CHUNK_TOKENS", 8000))
+
+# 对齐查询使用结构化输出（JSON Schema 约束解码）及每个需求的最大生成token数
+ALIGN_STRUCTURED_OUTPUT = os.environ.get("ALIGN_STRUCTURED_OUTPUT", "1") == "1"
+ALIGN_MAX_TOKENS = int(os.environ.get("ALIGN_MAX_TOKENS", 256))
+# 停止序列只配合结构化输出使用：普通模式下提示词要求输出 ```json 代码块，停止序列会截断开头的代码块标记
+ALIGN_STOP_SEQUENCES = ["\n```"]
+
+# 两阶段（骨架优先）对齐：先按代码骨架选出相关结构，再只发送选中结构的完整代码
+ALIGN_HIERARCHICAL = os.environ.get("ALIGN_HIERARCHICAL", "0") == "1"
+
+# 批量对齐时每个提示词打包的需求点数量
+ALIGN_BATCH_SIZE = int(os.environ.get("ALIGN_BATCH_SIZE", 8))
+
+# 发送前压缩代码（去除注释、空行和多余空白，保留原始行号）
+CODE_COMPACTION = os.environ.get("CODE_COMPACTION", "0") == "1"
+
+# 批量审查时并发执行的审查请求数
+REVIEW_CONCURRENCY = int(os.environ.get("REVIEW_CONCURRENCY", 8))
+
+# 审查提示词的 token 上限，超过时将相关代码分组审查后再汇总（map-reduce）
+REVIEW_CONTEXT_TOKENS = int(os.environ.get("REVIEW_CONTEXT_TOKENS", 24000))
+
+
+# 视为推理服务过载的异常：429 / 5xx / 超时
+OVERLOAD_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APITimeoutError)
+
+# 视为推理服务故障的异常：连接失败（含超时）/ 5xx，计入节点健康状态，并可换一个推理服务重试
+ENDPOINT_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+
+# 在同一推理服务上重试的异常：连接失败（含超时）/ 429 / 5xx
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+
+def retry_delay(attempt):
+    """第 attempt 次（从 0 开始）重试前的等待时间：指数退避并加随机抖动"""
+    return min(LLM_RETRY_MAX_DELAY, LLM_RETRY_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+# 对齐输出的 JSON Schema
+INTERVAL_LIST_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "array",
+        "items": {"type": "integer", "minimum": 1},
+        "minItems": 2,
+        "maxItems": 2
+    }
+}
+ALIGN_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {"related_code": INTERVAL_LIST_SCHEMA},
+    "required": ["related_code"],
+    "additionalProperties": False
+}
+
+# 推理服务拒绝结构化输出时错误信息中的关键字，用于区分其他参数错误
+STRUCTURED_OUTPUT_ERROR_KEYWORDS = ("response_format", "json_schema", "guided", "structured output")
+
+
+def is_structured_output_error(error):
+    """判断 BadRequestError 是否由推理服务不支持结构化输出（response_format / 约束解码）引起"""
+    message = str(error).lower()
+    return any(keyword in message for keyword in STRUCTURED_OUTPUT_ERROR_KEYWORDS)
+
+
+# ================= 大模型调用网关 =================
+class LLMGateway:
+    """
+    进程级的大模型调用网关
     
+    每个 base_url 只创建一个 OpenAI 客户端，所有调用共享其 keep-alive 连接池，
+    避免每次调用都重新建立 TCP/TLS 连接；并为每个 base_url 维护一个自适应并发限制器。
+    配置了多个推理服务时，未指定 base_url 的请求由 EndpointRouter 选择节点（最少在途请求 + 前缀亲和），
+    节点故障时换一个节点重试一次。
+    推理服务不支持结构化输出时，该节点后续请求自动去掉 response_format 及与之配合的 stop
+    （按节点记录，不影响其他节点）。
+    """
+
+    def __init__(self, api_key=API_KEY, max_connections=LLM_MAX_CONNECTIONS,
+                 max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                 timeout=LLM_TIMEOUT, connect_timeout=LLM_CONNECT_TIMEOUT,
+                 max_retries=LLM_MAX_RETRIES, base_urls=None):
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self._clients = {}
+        self._limiters = {}
+        self._structured_output_unsupported = set()  # 不支持结构化输出的 base_url
+        self._lock = threading.Lock()
+        self._closed = False
+        self.router = EndpointRouter(base_urls or API_BASE_URLS, probe=self.probe_endpoint)
+
+    def get_client(self, base_url=None):
+        """获取（必要时创建）指定 base_url 对应的长连接客户端"""
+        base_url = base_url or self.router.base_urls[0]
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("LLM 网关已关闭")
+            client = self._clients.get(base_url)
+            if client is None:
+                http_client = httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=self.max_connections,
+                        max_keepalive_connections=self.max_keepalive_connections,
+                    ),
+                    timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                )
+                # 重试由网关执行（见 _create_chat / stream_chat），每次失败都作为过载信号交给并发限制器，
+                # 重试等待也不计入请求延迟
+                client = OpenAI(
+                    api_key=self.api_key,
+                    base_url=base_url,
+                    http_client=http_client,
+                    max_retries=0,
+                )
+                self._clients[base_url] = client
+        return client
+
+    def get_limiter(self, base_url=None):
+        """获取指定 base_url 对应的自适应并发限制器"""
+        base_url = base_url or self.router.base_urls[0]
+        with self._lock:
+            limiter = self._limiters.get(base_url)
+            if limiter is None:
+                limiter = AdaptiveLimiter(max_limit=min(LLM_LIMIT_MAX, self.max_connections))
+                self._limiters[base_url] = limiter
+        return limiter
+
+    def probe_endpoint(self, base_url):
+        """健康检查：请求推理服务的模型列表，失败时抛出异常"""
+        self.get_client(base_url).with_options(timeout=LLM_HEALTH_CHECK_TIMEOUT, max_retries=0).models.list()
+
+    def chat(self, messages, model=MODEL_NAME, base_url=None, task="chat", **params):
+        """
+        发送一次 chat completion 请求（受自适应并发限制器约束，按当前上下文的优先级排队），并记录调用遥测
+
+        未指定 base_url 时由路由器选择推理服务，所选节点故障时换一个节点重试一次。
+        """
+        if base_url is not None:
+            return self._chat(messages, model, base_url, task, **params)
+
+        affinity_key = make_affinity_key(_messages_text(messages))
+        attempts = min(2, len(self.router.base_urls))
+        tried = []
+        for attempt in range(attempts):
+            base_url = self.router.select(affinity_key, exclude=tried)
+            tried.append(base_url)
+            start = time.monotonic()
+            try:
+                response = self._chat(messages, model, base_url, task, **params)
+            except ENDPOINT_ERRORS as e:
+                self.router.finish(base_url, error=type(e).__name__)
+                if attempt == attempts - 1:
+                    raise
+                print(f"推理服务 {base_url} 请求失败，换一个推理服务重试: {str(e)}")
+                continue
+            except Exception:
+                self.router.finish(base_url)
+                raise
+            usage = getattr(response, "usage", None)
+            self.router.finish(base_url, latency=time.monotonic() - start,
+                               tokens=usage.total_tokens if usage else None)
+            return response
+
+    def _chat(self, messages, model, base_url, task, **params):
+        # stop 与 response_format 配合使用（如对齐的 ["\n```"]），普通模式下会截断 ```json 代码块，因此一并去掉
+        if "response_format" in params and base_url in self._structured_output_unsupported:
+            params.pop("response_format")
+            params.pop("stop", None)
+        try:
+            return self._create_chat(messages, model, base_url, task, **params)
+        except openai.BadRequestError as e:
+            if "response_format" not in params or not is_structured_output_error(e):
+                raise
+            print(f"推理服务 {base_url} 不支持结构化输出，退回普通模式: {str(e)}")
+            with self._lock:
+                self._structured_output_unsupported.add(base_url)
+            params.pop("response_format")
+            params.pop("stop", None)
+            return self._create_chat(messages, model, base_url, task, **params)
+
+    def _create_chat(self, messages, model, base_url, task, **params):
+        client = self.get_client(base_url)
+        limiter = self.get_limiter(base_url)
+        priority, tenant = current_llm_priority()
+        for attempt in range(self.max_retries + 1):
+            queue_wait = limiter.acquire(priority, tenant)
+            start = time.monotonic()
+            try:
+                response = client.chat.completions.create(
+                    messages=messages,
+                    model=model,
+                    **params
+                )
+                break
+            except Exception as e:
+                limiter.release(overloaded=isinstance(e, OVERLOAD_ERRORS))
+                get_llm_metrics().record_call(task, model, time.monotonic() - start, queue_wait,
+                                              error=type(e).__name__, priority=priority, endpoint=base_url)
+                if not isinstance(e, RETRYABLE_ERRORS) or attempt == self.max_retries:
+                    raise
+                print(f"推理服务 {base_url} 请求失败，稍后重试: {str(e)}")
+                time.sleep(retry_delay(attempt))
+        latency = time.monotonic() - start
+        usage = getattr(response, "usage", None)
+        limiter.release(latency=latency, tokens=usage.total_tokens if usage else None, task=task)
+        get_llm_metrics().record_call(
+            task, model, latency, queue_wait,
+            prompt_tokens=usage.prompt_tokens if usage else None,
+            completion_tokens=usage.completion_tokens if usage else None,
+            priority=priority,
+            endpoint=base_url
+        )
+        return response
+
+    def stream_chat(self, messages, model=MODEL_NAME, base_url=None, task="chat", **params):
+        """
+        以流式方式发送 chat completion 请求，逐段产出生成的文本
+        
+        并发额度在整个流结束（或调用方提前关闭生成器）后才归还。未指定 base_url 时由路由器选择推理服务。
+        """
+        routed = base_url is None
+        if routed:
+            base_url = self.router.select(make_affinity_key(_messages_text(messages)))
+        priority, tenant = current_llm_priority()
+        acquired = False
+        start = time.monotonic()
+        completed = False
+        error = None
+        usage = None
+        # 选定节点后的所有步骤（包括获取客户端、排队）都在 try 中，保证路由器的在途请求数一定被扣减
+        try:
+            client = self.get_client(base_url)
+            limiter = self.get_limiter(base_url)
+            for attempt in range(self.max_retries + 1):
+                queue_wait = limiter.acquire(priority, tenant)
+                acquired = True
+                start = time.monotonic()
+                try:
+                    stream = client.chat.completions.create(
+                        messages=messages,
+                        model=model,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                        **params
+                    )
+                    break
+                except RETRYABLE_ERRORS as e:
+                    # 尚未产出任何内容，可以重试；最后一次失败交给外层 finally 处理
+                    if attempt == self.max_retries:
+                        raise
+                    acquired = False
+                    limiter.release(overloaded=isinstance(e, OVERLOAD_ERRORS))
+                    print(f"推理服务 {base_url} 请求失败，稍后重试: {str(e)}")
+                    time.sleep(retry_delay(attempt))
+            with stream:
+                for chunk in stream:
+                    if chunk.usage:
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            completed = True
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            latency = time.monotonic() - start
+            if routed:
+                self.router.finish(
+                    base_url,
+                    latency=latency if completed else None,
+                    tokens=usage.total_tokens if usage else None,
+                    error=type(error).__name__ if isinstance(error, ENDPOINT_ERRORS) else None
+                )
+            if acquired:
+                if completed:
+                    limiter.release(latency=latency, tokens=usage.total_tokens if usage else None, task=task)
+                else:
+                    # error 为空表示调用方提前关闭了生成器
+                    limiter.release(overloaded=isinstance(error, OVERLOAD_ERRORS))
+                get_llm_metrics().record_call(
+                    task, model, latency, queue_wait,
+                    prompt_tokens=usage.prompt_tokens if usage else None,
+                    completion_tokens=usage.completion_tokens if usage else None,
+                    error=None if completed else (type(error).__name__ if error else "Cancelled"),
+                    priority=priority,
+                    endpoint=base_url
+                )
+
+    def stats(self):
+        """各推理服务的并发窗口、排队情况与负载均衡状态（在途请求、延迟、健康状况）"""
+        with self._lock:
+            limiters = dict(self._limiters)
+        stats = {base_url: limiter.stats() for base_url, limiter in limiters.items()}
+        for base_url, endpoint_stats in self.router.stats().items():
+            stats.setdefault(base_url, {})["routing"] = endpoint_stats
+        return stats
+
+    def close(self):
+        """关闭所有客户端并释放连接池"""
+        self.router.close()
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._closed = True
+        for client in clients:
+            try:
+                client.close()
+            except Exception as e:
+                print(f"关闭LLM客户端时出错: {str(e)}")
+
+
+def _messages_text(messages):
+    """对话消息的文本内容，用于计算前缀亲和键"""
+    return "".join(str(message.get("content", "")) for message in messages)
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_llm_gateway():
+    """获取进程级共享的 LLM 网关，首次调用时创建"""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway()
+        return _gateway
+
+
+def shutdown_llm_gateway():
+    """关闭共享的 LLM 网关（进程退出时自动调用）"""
+    global _gateway
+    with _gateway_lock:
+        gateway, _gateway = _gateway, None
+    if gateway is not None:
+        gateway.close()
+
+
+atexit.register(shutdown_llm_gateway)
+
+_single_flight = SingleFlight()
+
+
+def query_llm(message, history=None, use_cache=True, cache_path=None,
+              max_tokens=None, stop=None, response_format=None, task="chat"):
+    """
+    调用大模型
+    
+    参数:
+        message: 用户消息
+        history: 历史对话消息列表
+        use_cache: 是否使用持久化回复缓存，为 False 时强制重新生成
+        cache_path: 缓存文件路径，默认使用全局缓存文件
+        max_tokens: 最大生成token数
+        stop: 停止序列
+        response_format: 结构化输出格式（如 JSON Schema 约束）
+        task: 任务类型（如 align、review），用于调用遥测的分类统计
+    """
     if history is None:
         messages = []
     else:
         messages = history
         
     messages.append({"role": "user", "content": message})
-    response = client.chat.completions.create(
-        messages=messages, 
-        model=MODEL_NAME,
-        temperature=0.1,
-        top_p=0.9,
-        n= 1
-    )
-    result = response.choices[0].message
+    params = {"temperature": 0.1, "top_p": 0.9}
+    extra_params = {"max_tokens": max_tokens, "stop": stop, "response_format": response_format}
+    extra_params = {key: value for key, value in extra_params.items() if value is not None}
+    params.update(extra_params)
+    request_key = make_cache_key(MODEL_NAME, messages, params["temperature"], params["top_p"], **extra_params)
+
+    cache = None
+    if use_cache:
+        try:
+            cache = get_llm_cache(cache_path)
+            cached = cache.get(request_key)
+            if cached is not None:
+                get_llm_metrics().record_cache_hit(task, MODEL_NAME)
+                return ChatCompletionMessage(role="assistant", content=cached)
+        except Exception as e:
+            print(f"读取LLM缓存时出错: {str(e)}")
+            cache = None
+
+    executed = []
+
+    def generate():
+        executed.append(True)
+        response = get_llm_gateway().chat(
+            messages=messages,
+            task=task,
+            n=1,
+            **params
+        )
+        result = response.choices[0].message
+        log_llm_call(task, message, result.content, model=MODEL_NAME)
+
+        if cache is not None and result.content:
+            try:
+                cache.put(request_key, MODEL_NAME, result.content)
+            except Exception as e:
+                print(f"写入LLM缓存时出错: {str(e)}")
+        return result
+
+    # 相同请求正在执行时共享其结果，不重复生成；键包含缓存文件路径，保证结果写入各自的缓存
+    result = _single_flight.do((request_key, cache_path), generate)
+    if not executed:
+        get_llm_metrics().record_shared(task)
     return result
 
+
+def stream_llm(message, use_cache=True, cache_path=None, task="chat"):
+    """
+    以流式方式调用大模型，逐段产出生成的文本
+    
+    缓存命中时一次性产出缓存的完整回复；流正常结束后写入缓存。
+    """
+    messages = [{"role": "user", "content": message}]
+    params = {"temperature": 0.1, "top_p": 0.9}
+    request_key = make_cache_key(MODEL_NAME, messages, params["temperature"], params["top_p"])
+
+    cache = None
+    if use_cache:
+        try:
+            cache = get_llm_cache(cache_path)
+            cached = cache.get(request_key)
+            if cached is not None:
+                get_llm_metrics().record_cache_hit(task, MODEL_NAME)
+                yield cached
+                return
+        except Exception as e:
+            print(f"读取LLM缓存时出错: {str(e)}")
+            cache = None
+
+    parts = []
+    for delta in get_llm_gateway().stream_chat(messages=messages, task=task, n=1, **params):
+        parts.append(delta)
+        yield delta
+
+    content = "".join(parts)
+    log_llm_call(task, message, content, model=MODEL_NAME)
+    if cache is not None and content:
+        try:
+            cache.put(request_key, MODEL_NAME, content)
+        except Exception as e:
+            print(f"写入LLM缓存时出错: {str(e)}")
+
+
+def get_single_flight_stats():
+    """相同请求合并的统计：实际执行次数与被合并的重复请求数"""
+    return _single_flight.stats()
+
 # ================= 对齐 相关代码 =================
-def query_related_code(requirement, code_files, split_code=False):
+def query_related_code(requirement, code_files, split_code=False, max_workers=None, use_cache=True, cache_path=None,
+                       top_k=None, index=None):
     """
     查询与需求点最相关的代码行号
     
     参数:
         requirement: 需求文本
         code_files: 代码文件列表，每个文件包含名称和内容
-        split_code: 是否将代码文件拆分为块
+        split_code: 是否按 token 预算对代码文件进行打包/分块（需要提供原始代码 content）
+        max_workers: 并发请求数，默认取 LLM_CONCURRENCY，小于等于1时串行执行
+        use_cache: 是否使用LLM回复缓存
+        cache_path: 缓存文件路径
+        top_k: 按词法相关度保留的候选代码块数量，默认取 ALIGN_TOP_K，0 表示全部发送
+        index: 预先建立的代码块词法索引（如项目级索引），为空时临时建立
         
     返回:
         相关行号列表
     """
     if split_code:
-        # 如果需要对代码进行分块处理
-        split_code_files = []
-        for code_file in code_files:
-            lines = code_file["numberedContent"].splitlines()
-            for i in range(0, len(lines), 1000):
-                chunk_content = "\n".join(lines[i:i + 1000])
-                split_code_files.append({
-                    "name": code_file['name'],
-                    "numberedContent": chunk_content
-                })
-        code_files = split_code_files  # Replace original code_files with split chunks
+        # 按 token 预算打包：小文件合并到同一提示词，大文件按代码结构拆分
+        code_files = pack_code_files(code_files, max_tokens=ALIGN_CHUNK_TOKENS)
+    code_files = [normalize_code_file(code_file) for code_file in code_files]
+
+    # 词法预过滤，只向模型发送候选代码块
+    candidate_indices = select_candidate_chunks([requirement], code_files, top_k, index)[0]
+    code_files = [code_files[i] for i in candidate_indices]
+
+    if max_workers is None:
+        max_workers = LLM_CONCURRENCY
+    max_workers = min(max_workers, len(code_files))
+
+    # 各代码块并发查询，结果按输入顺序（文件/行号顺序）收集
+    if max_workers <= 1:
+        chunk_results = [align_code_file(requirement, code_file, use_cache, cache_path) for code_file in code_files]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            chunk_results = list(map_in_context(
+                executor,
+                lambda code_file: align_code_file(requirement, code_file, use_cache, cache_path),
+                code_files
+            ))
 
     related_code_blocks = []
+    for blocks in chunk_results:
+        related_code_blocks.extend(blocks)
+    
+    return related_code_blocks
+
+
+def query_related_code_hierarchical(requirement, code_files, max_workers=None, use_cache=True, cache_path=None):
+    """
+    两阶段（骨架优先）对齐：
+    1. 只发送各文件的代码骨架（签名及行号范围），由模型选出可能相关的代码结构
+    2. 只发送选中结构的完整代码，查询精确的相关行号
+    
+    参数:
+        requirement: 需求文本
+        code_files: 代码文件列表，每个文件包含 name 和 content（原始代码）
+        max_workers: 并发请求数，默认取 LLM_CONCURRENCY
+        use_cache: 是否使用LLM回复缓存
+        cache_path: 缓存文件路径
+        
+    返回:
+        相关代码块列表
+    """
+    encoder = get_token_encoder()
+    if max_workers is None:
+        max_workers = LLM_CONCURRENCY
+
+    # 1. 生成骨架并按 token 预算分组，条目编号在所有文件中唯一
+    file_lines = {}
+    entries = {}  # 编号 -> (文件名, 骨架条目)
+    groups, current_group, current_tokens = [], [], 0
     for code_file in code_files:
-        # 构造提示词
-        template = ALIGN_PROMPT_TEMPLATE
-        prompt = template.format(
-            req_content=requirement,
-            code_content=code_file["numberedContent"]
-        )
-        print("input: ", prompt)
+        file_lines[code_file["name"]] = code_file["content"].splitlines()
+        for entry in build_code_skeleton(code_file["content"], filename=code_file["name"]):
+            entry_id = f"S{len(entries) + 1}"
+            entries[entry_id] = (code_file["name"], entry)
+            entry_tokens = estimate_tokens(encoder, format_skeleton_entry(entry_id, entry))
+            if current_group and current_tokens + entry_tokens > ALIGN_CHUNK_TOKENS:
+                groups.append(current_group)
+                current_group, current_tokens = [], 0
+            current_group.append(entry_id)
+            current_tokens += entry_tokens
+    if current_group:
+        groups.append(current_group)
+    if not groups:
+        return []
+
+    # 2. 阶段一：按骨架选出相关的代码结构
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups)))) as executor:
+        selected_groups = list(map_in_context(
+            executor,
+            lambda group: select_skeleton_entries(requirement, group, entries, use_cache, cache_path),
+            groups
+        ))
+    selected_ids = [entry_id for group in selected_groups for entry_id in group]
+    print(f"骨架对齐: 选中 {len(selected_ids)}/{len(entries)} 个代码结构")
+    if not selected_ids:
+        return []
+
+    # 3. 阶段二：将选中结构的完整代码（保留原始行号）打包，查询精确的相关行号
+    spans = {}
+    for entry_id in selected_ids:
+        name, entry = entries[entry_id]
+        spans.setdefault(name, []).append([entry["start"], entry["end"]])
+    units = []
+    for code_file in code_files:
+        name = code_file["name"]
+        line_token_counts = numbered_line_tokens(code_file["content"])
+        merged = []
+        for start, end in sorted(spans.get(name, [])):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        for start, end in merged:
+            lines = file_lines[name][start - 1:end]
+            units.append({"name": name, "lines": lines, "first_line": start,
+                          "tokens": sum(line_token_counts[start - 1:end])})
+
+    return query_related_code(
+        requirement, pack_code_units(units, ALIGN_CHUNK_TOKENS),
+        max_workers=max_workers, use_cache=use_cache, cache_path=cache_path, top_k=0
+    )
+
+
+def format_skeleton_entry(entry_id, entry):
+    """格式化一条骨架条目：[编号] 起始行-结束行: 签名"""
+    return f"[{entry_id}] {entry['start']}-{entry['end']}: {entry['text']}\n"
+
+
+def select_skeleton_entries(requirement, entry_ids, entries, use_cache=True, cache_path=None):
+    """
+    阶段一：向模型发送一组骨架条目，返回选中的条目编号
+    
+    模型输出无法解析时保守地返回该组全部条目，由阶段二进一步筛选。
+    """
+    parts = []
+    current_name = None
+    for entry_id in entry_ids:
+        name, entry = entries[entry_id]
+        if name != current_name:
+            parts.append(f"// ===== 文件: {name} =====\n")
+            current_name = name
+        parts.append(format_skeleton_entry(entry_id, entry))
+
+    prompt = SKELETON_ALIGN_PROMPT_TEMPLATE.format(
+        req_content=format_requirement(requirement),
+        skeleton_content="".join(parts)
+    )
+    schema = {
+        "type": "object",
+        "properties": {
+            "related_blocks": {"type": "array", "items": {"type": "string", "enum": list(entry_ids)}}
+        },
+        "required": ["related_blocks"],
+        "additionalProperties": False
+    }
+    llm_output = query_alignment_llm(prompt, schema, ALIGN_MAX_TOKENS * 2, use_cache, cache_path,
+                                     task="skeleton_align")
+
+    valid_ids = set(entry_ids)
+    data = load_json_output(llm_output)
+    if isinstance(data, dict) and isinstance(data.get("related_blocks"), list):
+        selected = [entry_id for entry_id in data["related_blocks"] if entry_id in valid_ids]
+    else:
+        selected = [entry_id for entry_id in re.findall(r'S\d+', llm_output) if entry_id in valid_ids]
+        if not selected and "related_blocks" not in llm_output:
+            print("无法解析骨架对齐结果，保留该组全部代码结构")
+            selected = list(entry_ids)
+    return list(dict.fromkeys(selected))
+
+
+def align_code_file(requirement, code_file, use_cache=True, cache_path=None):
+    """
+    查询单个代码文件（块）中与需求相关的代码段
+    
+    参数:
+        requirement: 需求点（字典）或需求文本
+        code_file: 代码文件，包含名称和带行号的内容
+        use_cache: 是否使用LLM回复缓存
+        cache_path: 缓存文件路径
         
-        # 解析回复
-        response = query_llm(prompt)
-        llm_output = response.content
-        print("llm output: ", llm_output)
-        parsed_output = parse_alignment_output(llm_output)
+    返回:
+        相关代码块列表，按起始行号排序；模型输出无法解析时返回空列表
+    """
+    # 构造提示词
+    template = ALIGN_PROMPT_TEMPLATE
+    prompt = template.format(
+        req_content=format_requirement(requirement),
+        code_content=prepare_prompt_code(code_file["numberedContent"], code_file["name"])
+    )
+    
+    # 解析回复
+    llm_output = query_alignment_llm(prompt, ALIGN_RESPONSE_SCHEMA, ALIGN_MAX_TOKENS, use_cache, cache_path)
+    parsed_output = parse_alignment_output(llm_output)
+    
+    # 输出无法解析时只跳过该代码块，不影响其他代码块的结果
+    if parsed_output is None:
+        print(f"无法解析对齐结果，跳过代码块: {code_file['name']}")
+        return []
+    
+    return extract_code_blocks(code_file, parsed_output)
+
+
+def query_alignment_llm(prompt, schema, max_tokens, use_cache=True, cache_path=None, task="align"):
+    """
+    调用大模型执行对齐查询，返回模型输出文本
+    
+    启用结构化输出时通过 response_format 传入 JSON Schema（vLLM 会据此进行约束解码），
+    并限制最大生成长度、设置停止序列，减少无效生成和解析失败。
+    推理服务不支持结构化输出时由 LLMGateway 按节点自动退回普通模式。
+    停止序列只在结构化输出时使用，普通模式下模型输出的 ```json 代码块不会被截断。
+    """
+    response_format = None
+    stop = None
+    if ALIGN_STRUCTURED_OUTPUT:
+        response_format = {
+            "type": "json_schema",
+            "json_schema": {"name": "alignment", "schema": schema}
+        }
+        stop = ALIGN_STOP_SEQUENCES
+
+    response = query_llm(prompt, use_cache=use_cache, cache_path=cache_path, max_tokens=max_tokens,
+                         stop=stop, response_format=response_format, task=task)
+    return response.content or ""
+
+
+_compaction_stats = {"prompts": 0, "tokens_before": 0, "tokens_after": 0}
+_compaction_lock = threading.Lock()
+
+
+def prepare_prompt_code(content, filename=""):
+    """
+    构造提示词前处理代码内容：启用 CODE_COMPACTION 时压缩代码并统计节省的 token 数
+    
+    压缩只影响发送给模型的文本，代码块的提取仍基于原始内容。
+    """
+    if not CODE_COMPACTION:
+        return content
+    compacted = compact_code(content, filename)
+    encoder = get_token_encoder()
+    tokens_before = estimate_tokens(encoder, content)
+    tokens_after = estimate_tokens(encoder, compacted)
+    with _compaction_lock:
+        _compaction_stats["prompts"] += 1
+        _compaction_stats["tokens_before"] += tokens_before
+        _compaction_stats["tokens_after"] += tokens_after
+    print(f"代码压缩: {filename} {tokens_before} -> {tokens_after} tokens")
+    return compacted
+
+
+def get_compaction_stats():
+    """代码压缩统计：处理的代码段数、压缩前后的 token 数及节省的 token 数"""
+    with _compaction_lock:
+        stats = dict(_compaction_stats)
+    stats["enabled"] = CODE_COMPACTION
+    stats["tokens_saved"] = stats["tokens_before"] - stats["tokens_after"]
+    return stats
+
+
+def normalize_code_file(code_file):
+    """
+    统一代码文件（块）的表示形式
+    
+    前端传入的代码文件与 pack_code_files 产生的打包块为 {"name", "numberedContent"}，
+    split_code 产生的代码块为 {"filename", "content", "start_line", "end_line"}（content 已带行号），
+    统一转换为前者。
+    """
+    if "numberedContent" in code_file:
+        return code_file
+    return {
+        "name": code_file["filename"],
+        "numberedContent": code_file["content"]
+    }
+
+
+def extract_code_blocks(code_file, intervals):
+    """
+    合并行号区间并从代码文件中提取对应的代码
+    
+    参数:
+        code_file: 代码文件，包含名称和带行号的内容
+        intervals: 行号区间列表 [[start, end], ...]
         
-        # Ensure parsed_output contains intervals (e.g., [start, end])
-        if all(isinstance(item, list) and len(item) == 2 for item in parsed_output):
-            # Sort intervals by their starting line number
-            parsed_output = sorted(parsed_output, key=lambda x: x[0])  # 按起始行号排序
+    返回:
+        相关代码块列表，按起始行号排序
+    """
+    # 多文件打包块：将全局行号区间映射回各文件的原始行号
+    if "segments" in code_file:
+        related_code_blocks = []
+        for segment in code_file["segments"]:
+            shift = segment["first_line"] - segment["start"]
+            segment_intervals = [
+                [max(start, segment["start"]) + shift, min(end, segment["end"]) + shift]
+                for start, end in intervals
+                if start <= segment["end"] and end >= segment["start"]
+            ]
+            if segment_intervals:
+                related_code_blocks.extend(extract_code_blocks(segment, segment_intervals))
+        return related_code_blocks
+
+    # 对行号区间进行排序并合并有交集的代码块
+    intervals = sorted(intervals, key=lambda x: x[0])  # 按起始行号排序
+    merged_blocks = []
+    
+    for interval in intervals:
+        if len(merged_blocks) == 0 or merged_blocks[-1][1] < interval[0] - 1:
+            merged_blocks.append(list(interval))
         else:
-            return []
-            
-        # 对行号区间进行排序并合并有交集的代码块
-        parsed_output = sorted(parsed_output, key=lambda x: x[0])  # 按起始行号排序
-        merged_blocks = []
+            merged_blocks[-1][1] = max(merged_blocks[-1][1], interval[1])
+
+    # 从代码块中提取对应的代码
+    related_code_blocks = []
+    for block in merged_blocks:
+        start_line, end_line = block
+        block_content = "\n".join(
+            line
+            for line in code_file["numberedContent"].splitlines()
+            if line.strip() and ":" in line and start_line <= int(line.split(":")[0]) <= end_line
+        )
+        related_code_blocks.append({
+            "filename": code_file["name"],
+            "content": block_content,
+            "start": start_line,
+            "end": end_line
+        })
+    
+    return related_code_blocks
+
+
+def query_related_code_batch(requirement_points, code_files, batch_size=ALIGN_BATCH_SIZE,
+                             max_workers=None, use_cache=True, cache_path=None,
+                             top_k=None, index=None):
+    """
+    批量对齐：将多个需求点打包进同一个提示词，每个代码块只发送一次
+    
+    参数:
+        requirement_points: 需求点列表（parse_markdown 的输出）
+        code_files: 代码文件（块）列表
+        batch_size: 每个提示词中打包的需求点数量
+        max_workers: 并发请求数，默认取 LLM_CONCURRENCY
+        use_cache: 是否使用LLM回复缓存
+        cache_path: 缓存文件路径
+        top_k: 每个需求点按词法相关度保留的候选代码块数量，默认取 ALIGN_TOP_K，0 表示全部发送
+        index: 预先建立的代码块词法索引（如项目级索引），为空时临时建立
         
-        for interval in parsed_output:
-            if len(merged_blocks) == 0 or merged_blocks[-1][1] < interval[0] - 1:
-                merged_blocks.append(interval)
-            else:
-                merged_blocks[-1][1] = max(merged_blocks[-1][1], interval[1])
+    返回:
+        列表，与 requirement_points 一一对应，每个元素为该需求点的相关代码块列表
+    """
+    code_files = [normalize_code_file(code_file) for code_file in code_files]
+    batch_size = max(1, batch_size)
+
+    # 每个需求点的候选代码块下标
+    candidates = [
+        set(indices)
+        for indices in select_candidate_chunks(requirement_points, code_files, top_k, index)
+    ]
+
+    # 每个任务为（代码块，该代码块对应的一批需求点下标），只打包以该代码块为候选的需求点
+    tasks = []
+    for batch_start in range(0, len(requirement_points), batch_size):
+        batch_indices = range(batch_start, min(batch_start + batch_size, len(requirement_points)))
+        for chunk_index, code_file in enumerate(code_files):
+            point_indices = [i for i in batch_indices if chunk_index in candidates[i]]
+            if point_indices:
+                tasks.append((code_file, point_indices))
+
+    if max_workers is None:
+        max_workers = LLM_CONCURRENCY
+    max_workers = min(max_workers, len(tasks))
+
+    def run_task(task):
+        code_file, point_indices = task
+        points = [requirement_points[i] for i in point_indices]
+        return align_code_file_batch(points, code_file, use_cache, cache_path)
+
+    if max_workers <= 1:
+        task_results = [run_task(task) for task in tasks]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            task_results = list(map_in_context(executor, run_task, tasks))
+
+    # 按 批次/代码块 的输入顺序拆分回各需求点，保证结果顺序确定
+    results = [[] for _ in requirement_points]
+    for (_, point_indices), blocks_per_point in zip(tasks, task_results):
+        for i, blocks in zip(point_indices, blocks_per_point):
+            results[i].extend(blocks)
+    return results
+
+
+def query_related_code_incremental(requirement_points, code_units, previous_states=None,
+                                   batch_size=ALIGN_BATCH_SIZE, max_workers=None,
+                                   use_cache=True, cache_path=None, top_k=None, index=None):
+    """
+    增量对齐：按代码单元（split_code_units 的输出）的内容哈希复用上次的对齐结果，
+    只将内容发生变化（或新增）的单元重新打包并查询大模型
+    
+    参数:
+        requirement_points: 需求点列表
+        code_units: 代码单元列表，包含 name、lines、first_line、tokens、hash
+        previous_states: 与 requirement_points 对应的上次对齐状态（见返回值），为空表示全部重新对齐
+        其余参数同 query_related_code_batch
         
-        print("merged blocks: ", merged_blocks)
+    返回:
+        列表，与 requirement_points 一一对应，每个元素为 (相关代码块列表, 对齐状态)。
+        对齐状态为 {"requirementHash": 需求内容哈希, "chunkResults": {单元哈希: 相对单元首行的行号区间}}，
+        区间以单元首行为第 1 行，单元整体移动时只需平移即可复用。
+    """
+    previous_states = previous_states or [None] * len(requirement_points)
+    current_hashes = {unit["hash"] for unit in code_units}
 
-        # 从代码块中提取对应的代码
-        for block in merged_blocks:
-            start_line, end_line = block
-            block_content = "\n".join(
-                line
-                for line in code_file["numberedContent"].splitlines()
-                if line.strip() and ":" in line and start_line <= int(line.split(":")[0]) <= end_line
-            )
-            related_code_blocks.append({
-                "filename": code_file["name"],
-                "content": block_content,
-                "start": start_line,
-                "end": end_line
+    # 需求内容不变时，保留仍存在于当前代码中的单元结果
+    requirement_hashes = [hash_requirement(point) for point in requirement_points]
+    chunk_results = []
+    for requirement_hash, state in zip(requirement_hashes, previous_states):
+        if state and state.get("requirementHash") == requirement_hash:
+            chunk_results.append({
+                key: value for key, value in state.get("chunkResults", {}).items()
+                if key in current_hashes
             })
-    
+        else:
+            chunk_results.append({})
+
+    batch_size = max(1, batch_size)
+    for batch_start in range(0, len(requirement_points), batch_size):
+        batch_indices = range(batch_start, min(batch_start + batch_size, len(requirement_points)))
+        changed_units = [
+            unit for unit in code_units
+            if any(unit["hash"] not in chunk_results[i] for i in batch_indices)
+        ]
+        if not changed_units:
+            continue
+
+        print(f"增量对齐: 需求点 {batch_start + 1}-{batch_indices[-1] + 1}, "
+              f"重新查询 {len(changed_units)}/{len(code_units)} 个代码单元")
+        related_code = query_related_code_batch(
+            [requirement_points[i] for i in batch_indices],
+            pack_code_units(changed_units, ALIGN_CHUNK_TOKENS),
+            batch_size=batch_size,
+            max_workers=max_workers,
+            use_cache=use_cache,
+            cache_path=cache_path,
+            top_k=top_k,
+            index=index
+        )
+        for i, blocks in zip(batch_indices, related_code):
+            for unit in changed_units:
+                chunk_results[i][unit["hash"]] = unit_relative_intervals(unit, blocks)
+
+    return [
+        (assemble_unit_code_blocks(code_units, results),
+         {"requirementHash": requirement_hash, "chunkResults": results})
+        for requirement_hash, results in zip(requirement_hashes, chunk_results)
+    ]
+
+
+def hash_requirement(requirement):
+    """需求点内容哈希，需求文本变化时对应的增量对齐结果全部失效"""
+    payload = format_requirement(requirement)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def unit_relative_intervals(unit, blocks):
+    """将相关代码块（原文件行号）中落在该单元内的部分转换为相对单元首行的区间"""
+    first_line = unit["first_line"]
+    last_line = first_line + len(unit["lines"]) - 1
+    intervals = []
+    for block in blocks:
+        if block["filename"] != unit["name"]:
+            continue
+        start, end = max(block["start"], first_line), min(block["end"], last_line)
+        if start <= end:
+            intervals.append([start - first_line + 1, end - first_line + 1])
+    return intervals
+
+
+def assemble_unit_code_blocks(code_units, chunk_results):
+    """按各单元当前的位置平移相对区间，合并为按文件组织的相关代码块"""
+    files = {}
+    for unit in code_units:
+        code_file = files.setdefault(unit["name"], {"name": unit["name"], "lines": [], "intervals": []})
+        code_file["lines"].extend(
+            f"{unit['first_line'] + i}: {line}" for i, line in enumerate(unit["lines"])
+        )
+        shift = unit["first_line"] - 1
+        code_file["intervals"].extend(
+            [start + shift, end + shift] for start, end in chunk_results.get(unit["hash"], [])
+        )
+
+    related_code_blocks = []
+    for code_file in files.values():
+        if code_file["intervals"]:
+            related_code_blocks.extend(extract_code_blocks(
+                {"name": code_file["name"], "numberedContent": "\n".join(code_file["lines"])},
+                code_file["intervals"]
+            ))
     return related_code_blocks
 
 
+def select_candidate_chunks(requirements, code_files, top_k=None, index=None):
+    """
+    词法预过滤：按 BM25 得分为每个需求选出候选代码块
+    
+    参数:
+        requirements: 需求列表（文本或需求点字典）
+        code_files: 代码块列表（{"name", "numberedContent"}）
+        top_k: 保留的候选数量，默认取 ALIGN_TOP_K，0 表示不过滤
+        index: 预先建立的词法索引，为空或不包含全部代码块时临时建立
+        
+    返回:
+        列表，与 requirements 一一对应，每个元素为候选代码块下标列表（按输入顺序）
+    """
+    if top_k is None:
+        top_k = ALIGN_TOP_K
+    if not top_k or len(code_files) <= top_k:
+        return [list(range(len(code_files))) for _ in requirements]
+
+    if index is None or not index.covers(code_files):
+        index = BM25Index.build(code_files)
+    return [index.top_k(format_requirement(requirement), code_files, top_k) for requirement in requirements]
+
+
+def align_code_file_batch(requirement_points, code_file, use_cache=True, cache_path=None):
+    """
+    查询单个代码文件（块）中与一批需求点分别相关的代码段
+    
+    返回:
+        列表，与 requirement_points 一一对应，每个元素为相关代码块列表
+    """
+    req_ids = [f"R{i + 1}" for i in range(len(requirement_points))]
+    req_content = "\n\n".join(
+        f"### 需求 {req_id}\n{format_requirement(point)}"
+        for req_id, point in zip(req_ids, requirement_points)
+    )
+    prompt = BATCH_ALIGN_PROMPT_TEMPLATE.format(
+        req_content=req_content,
+        code_content=prepare_prompt_code(code_file["numberedContent"], code_file["name"])
+    )
+    llm_output = query_alignment_llm(prompt, build_batch_alignment_schema(req_ids),
+                                     ALIGN_MAX_TOKENS * len(req_ids), use_cache, cache_path, task="batch_align")
+    parsed_output = parse_batch_alignment_output(llm_output, req_ids)
+    if parsed_output is None:
+        print(f"无法解析批量对齐结果，跳过代码块: {code_file['name']}")
+        return [[] for _ in requirement_points]
+
+    return [extract_code_blocks(code_file, parsed_output[req_id]) for req_id in req_ids]
+
+
+def format_requirement(requirement):
+    """将需求点格式化为提示词中的文本"""
+    if not isinstance(requirement, dict):
+        return str(requirement)
+    content = requirement.get("content", "")
+    if isinstance(content, dict):
+        content = json.dumps(content, ensure_ascii=False)
+    lines = []
+    if requirement.get("context"):
+        lines.append(f"所属章节: {requirement['context']}")
+    if requirement.get("type"):
+        lines.append(f"类型: {requirement['type']}")
+    lines.append(content)
+    return "\n".join(lines)
+
+
+def parse_batch_alignment_output(output, req_ids):
+    """
+    解析批量对齐的LLM输出，按需求编号拆分行号区间
+    
+    返回:
+        {需求编号: [[start, end], ...]}；无法解析时返回 None
+    """
+    result = load_json_output(output)
+    if isinstance(result, dict) and isinstance(result.get("related_code"), dict):
+        result = result["related_code"]
+    if not isinstance(result, dict):
+        return None
+
+    parsed = {}
+    for req_id in req_ids:
+        intervals = result.get(req_id, [])
+        parsed[req_id] = validate_intervals(intervals if isinstance(intervals, list) else [])
+    return parsed
+
+
+def build_batch_alignment_schema(req_ids):
+    """批量对齐输出的 JSON Schema：每个需求编号对应一个行号区间列表"""
+    return {
+        "type": "object",
+        "properties": {
+            "related_code": {
+                "type": "object",
+                "properties": {req_id: INTERVAL_LIST_SCHEMA for req_id in req_ids},
+                "required": list(req_ids),
+                "additionalProperties": False
+            }
+        },
+        "required": ["related_code"],
+        "additionalProperties": False
+    }
+
+
+def load_json_output(output):
+    """
+    从模型输出中读取JSON：去除Markdown代码块标记（包括被停止序列截断、未闭合的代码块）
+    和尾随逗号，解析失败时返回 None
+    """
+    text = output.strip()
+    json_match = re.search(r'```(?:json)?\s*(.*?)\s*```', text, re.DOTALL)
+    if json_match:
+        text = json_match.group(1)
+    else:
+        text = re.sub(r'^```(?:json)?', '', text).strip()
+    # 去除模型常见的尾随逗号
+    text = re.sub(r',\s*([}\]])', r'\1', text)
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return None
+
+
+def validate_intervals(intervals):
+    """校验行号区间列表，丢弃不是 [start, end] 正整数对的元素，并保证 start <= end"""
+    valid = []
+    for item in intervals:
+        if not isinstance(item, (list, tuple)) or len(item) != 2:
+            continue
+        if not all(isinstance(x, int) and not isinstance(x, bool) and x > 0 for x in item):
+            continue
+        valid.append([min(item), max(item)])
+    return valid
+
+
 def query_related_code_backup(requirement_point, code_blocks, language: str = "zh"):
     """
     查询与需求点最相关的代码行号
@@ -178,69 +1197,284 @@ def query_related_code_backup(requirement_point, code_blocks, language: str = "z
 
 def parse_alignment_output(output):
     """
-    解析LLM输出，提取行号列表
+    解析LLM输出，提取行号区间列表
     
     处理可能的情况：
-    1. 直接JSON输出
+    1. 直接JSON输出（结构化输出模式）
     2. Markdown代码块包裹的JSON
-    3. 不规范的JSON
-    """
-    # 尝试提取Markdown代码块中的JSON
-    json_match = re.search(r'```(?:json)?\s*({.*?})\s*```', output, re.DOTALL)
-    if json_match:
-        output = json_match.group(1)
+    3. 不规范的JSON（尾随逗号等）
+    4. 因长度限制被截断的JSON：提取其中完整的 [start, end] 对
     
-    try:
-        result = json.loads(output)
-        if isinstance(result, dict) and "related_code" in result:
-            return result["related_code"]
-        elif isinstance(result, list):
-            return result
-    except json.JSONDecodeError:
-        pass
+    返回:
+        [[start, end], ...]；无法解析时返回 None
+    """
+    result = load_json_output(output)
+    if isinstance(result, dict) and isinstance(result.get("related_code"), list):
+        return validate_intervals(result["related_code"])
+    elif isinstance(result, list):
+        return validate_intervals(result)
     
-    # 回退：尝试提取所有数字
-    return list(map(int, re.findall(r'\b\d+\b', output)))
+    # 回退：提取所有完整的行号区间
+    pairs = re.findall(r'\[\s*(\d+)\s*,\s*(\d+)\s*\]', output)
+    if pairs:
+        return validate_intervals([[int(start), int(end)] for start, end in pairs])
+    return None
 
 
 # ================= 审查 相关代码 =================
-def query_review_result(requirement, related_code):
+def query_review_result(requirement, related_code, use_cache=True, cache_path=None):
     """
     执行代码一致性审查
     
     参数:
         requirement: 需求内容
         related_code: 相关代码块列表，每个代码块包含文件名、内容等信息
+        use_cache: 是否使用LLM回复缓存
+        cache_path: 缓存文件路径
         
     返回:
         review_process: 审查过程
         issues: 问题单
     """
-    # 1. 拼接相关代码
+    # 1. 构造提示词（相关代码超出上下文时分组审查，再构造汇总提示词）
+    try:
+        prompt, task = prepare_review_request(requirement, related_code, use_cache, cache_path)
+
+        # 2. 调用LLM
+        response = query_llm(prompt, use_cache=use_cache, cache_path=cache_path, task=task)
+        parsed_output = parse_review_output(response.content)
+        
+    except Exception as e:
+        print(f"审查过程中出错: {str(e)}")
+        return None, None
+    
+    return parsed_output['review_process'], parsed_output['issues']
+
+
+def query_review_batch(items, max_workers=None, use_cache=True, cache_path=None, priority=PRIORITY_BATCH,
+                       tenant=None):
+    """
+    批量审查：通过有界线程池并发审查多个需求点，按完成顺序逐个返回结果
+    
+    参数:
+        items: 审查项列表，每项包含 id、requirement、relatedCode
+        max_workers: 并发审查数，默认取 REVIEW_CONCURRENCY
+        use_cache: 是否使用LLM回复缓存
+        cache_path: 缓存文件路径
+        priority: 审查请求的调度优先级，默认作为批量任务排在交互式请求之后
+        tenant: 批量任务所属的租户（通常为项目路径），用于在项目之间公平分配并发额度
+        
+    返回:
+        生成器，逐个产出 (id, review_process, issues)；审查失败时 review_process 与 issues 为 None
+    """
+    if not items:
+        return
+    if max_workers is None:
+        max_workers = REVIEW_CONCURRENCY
+    max_workers = max(1, min(max_workers, len(items)))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        with llm_priority(priority, tenant):
+            futures = {
+                submit_in_context(executor, query_review_result, item["requirement"], item.get("relatedCode", []),
+                                  use_cache, cache_path): item["id"]
+                for item in items
+            }
+        for future in as_completed(futures):
+            review_process, issues = future.result()
+            yield futures[future], review_process, issues
+    finally:
+        # 调用方提前结束（如客户端断开）时不再执行排队中的审查
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def stream_review_result(requirement, related_code, use_cache=True, cache_path=None):
+    """
+    以流式方式执行代码一致性审查，逐段产出模型生成的审查文本
+    
+    调用方在流结束后使用 parse_review_output 解析完整文本。
+    相关代码超出上下文时，先并行完成各组的审查，再流式输出汇总结果。
+    """
+    prompt, task = prepare_review_request(requirement, related_code, use_cache, cache_path)
+    yield from stream_llm(prompt, use_cache=use_cache, cache_path=cache_path, task=task)
+
+
+def prepare_review_request(requirement, related_code, use_cache=True, cache_path=None):
+    """
+    构造最终发送给模型的审查提示词，返回 (提示词, 任务类型)
+
+    相关代码未超出 REVIEW_CONTEXT_TOKENS 时直接返回审查提示词；
+    否则先并行审查各组代码，再返回（必要时分层汇总后的）汇总提示词。
+    代码压缩只执行一次，各组提示词也只构造一次。
+    """
+    prepared_code = prepare_review_code(related_code)
+    prompt = format_review_prompt(requirement, prepared_code)
+    code_groups = split_review_code(requirement, prepared_code, prompt=prompt)
+    if len(code_groups) == 1:
+        return prompt, "review"
+    group_prompts = [format_review_prompt(requirement, code_group) for code_group in code_groups]
+    partial_reviews = map_review_groups(group_prompts, use_cache, cache_path)
+    return reduce_review_groups(requirement, partial_reviews, use_cache, cache_path), "review_reduce"
+
+
+def split_review_code(requirement, related_code, max_tokens=None, prompt=None):
+    """
+    按 token 预算将相关代码块分组，使每组的审查提示词不超过上下文上限
+    
+    参数:
+        requirement: 需求内容
+        related_code: 已经过 prepare_review_code 处理的相关代码块列表
+        max_tokens: 审查提示词的 token 上限，默认取 REVIEW_CONTEXT_TOKENS
+        prompt: 已构造的完整审查提示词（可选，避免重复构造）
+        
+    返回:
+        代码块分组列表；未超出上限时只有一组（即原列表）
+
+    异常:
+        ValueError: 不含代码的提示词已占用超过上限的 3/4，无法合理分组
+    """
+    if max_tokens is None:
+        max_tokens = REVIEW_CONTEXT_TOKENS
+    encoder = get_token_encoder()
+    if prompt is None:
+        prompt = format_review_prompt(requirement, related_code)
+    if estimate_tokens(encoder, prompt) <= max_tokens:
+        return [related_code]
+
+    # 代码部分的预算 = 上限 - 不含代码的提示词长度
+    budget = max_tokens - estimate_tokens(encoder, format_review_prompt(requirement, []))
+    if budget < max_tokens // 4:
+        # 需求本身已占满大部分上下文：分组只会把代码拆成大量碎片，且各组提示词仍可能超出上限
+        raise ValueError(f"需求内容过长，留给相关代码的上下文不足 {max_tokens // 4} tokens，无法分组审查")
+
+    # 单个代码块超出预算时按行拆分
+    pieces = []
+    for block in related_code:
+        lines = block['content'].splitlines()
+        piece_lines, piece_tokens = [], 0
+        for line, line_tokens in zip(lines, count_tokens_batch([line + "\n" for line in lines])):
+            if piece_lines and piece_tokens + line_tokens > budget:
+                pieces.append((dict(block, content="\n".join(piece_lines)), piece_tokens))
+                piece_lines, piece_tokens = [], 0
+            piece_lines.append(line)
+            piece_tokens += line_tokens
+        pieces.append((dict(block, content="\n".join(piece_lines)), piece_tokens))
+
+    groups, current_group, current_tokens = [], [], 0
+    for piece, piece_tokens in pieces:
+        if current_group and current_tokens + piece_tokens > budget:
+            groups.append(current_group)
+            current_group, current_tokens = [], 0
+        current_group.append(piece)
+        current_tokens += piece_tokens
+    if current_group:
+        groups.append(current_group)
+    return groups
+
+
+def map_review_groups(prompts, use_cache=True, cache_path=None, task="review_map"):
+    """并行执行各组审查提示词，返回各组解析后的审查结果（与 prompts 顺序一致）"""
+    def review_group(prompt):
+        response = query_llm(prompt, use_cache=use_cache, cache_path=cache_path, task=task)
+        return parse_review_output(response.content)
+
+    print(f"分 {len(prompts)} 组审查后汇总（{task}）")
+    with ThreadPoolExecutor(max_workers=min(LLM_CONCURRENCY, len(prompts))) as executor:
+        return list(map_in_context(executor, review_group, prompts))
+
+
+def reduce_review_groups(requirement, partial_reviews, use_cache=True, cache_path=None, max_tokens=None):
+    """
+    构造不超过上下文上限的汇总提示词
+
+    各组审查结果合计超出 max_tokens（默认 REVIEW_CONTEXT_TOKENS）时分层汇总：
+    先把审查结果按预算分批，各批并行汇总，再汇总各批的结果，直到只剩一批。
+    单组结果超过预算的一半时截断，保证每一层至少两两合并，层数有限。
+    """
+    if max_tokens is None:
+        max_tokens = REVIEW_CONTEXT_TOKENS
+    encoder = get_token_encoder()
+    budget = max_tokens - estimate_tokens(encoder, build_review_reduce_prompt(requirement, []))
+    header_tokens = estimate_tokens(encoder, "## 第 99 组\n\n\n")  # 每组的标题与分隔
+
+    while True:
+        sections = [truncate_to_tokens(format_partial_review(review), budget // 2 - header_tokens)
+                    for review in partial_reviews]
+        batches, current_batch, current_tokens = [], [], 0
+        for section, section_tokens in zip(sections, count_tokens_batch(sections)):
+            section_tokens += header_tokens
+            if current_batch and current_tokens + section_tokens > budget:
+                batches.append(current_batch)
+                current_batch, current_tokens = [], 0
+            current_batch.append(section)
+            current_tokens += section_tokens
+        batches.append(current_batch)
+        if len(batches) == len(sections):
+            # 预算过小，无法合并任何两组：不再分层，直接汇总全部结果
+            batches = [sections]
+
+        prompts = [build_review_reduce_prompt(requirement, batch) for batch in batches]
+        if len(prompts) == 1:
+            return prompts[0]
+        partial_reviews = map_review_groups(prompts, use_cache, cache_path, task="review_reduce")
+
+
+def format_partial_review(review):
+    """格式化单组审查结果（不含组号）"""
+    return (f"### 审查分析过程\n{review['review_process']}\n"
+            f"### 问题单\n{review['issues']}")
+
+
+def truncate_to_tokens(text, max_tokens):
+    """按行截断文本，使其不超过 max_tokens 个 token"""
+    lines = text.splitlines(keepends=True)
+    line_tokens = count_tokens_batch(lines)
+    if sum(line_tokens) <= max_tokens:
+        return text
+    marker = "\n……（内容过长，已截断）"
+    remaining = max(0, max_tokens - estimate_tokens(get_token_encoder(), marker))
+    kept = []
+    for line, tokens in zip(lines, line_tokens):
+        if tokens > remaining:
+            # 按 token 比例截取行首部分
+            kept.append(line[:len(line) * remaining // tokens])
+            break
+        kept.append(line)
+        remaining -= tokens
+    return "".join(kept).rstrip("\n") + marker
+
+
+def build_review_reduce_prompt(requirement, partial_sections):
+    """构造汇总各组审查结果的提示词，partial_sections 为 format_partial_review 格式化后的各组结果"""
+    partial_text = "\n\n".join(
+        f"## 第 {idx + 1} 组\n{section}" for idx, section in enumerate(partial_sections)
+    )
+    return REVIEW_REDUCE_PROMPT_TEMPLATE.format(
+        group_count=len(partial_sections),
+        requirement=requirement,
+        partial_reviews=partial_text
+    )
+
+
+def prepare_review_code(related_code):
+    """对相关代码块执行提示词前处理（代码压缩），返回新的代码块列表"""
+    return [dict(block, content=prepare_prompt_code(block['content'], block['filename'])) for block in related_code]
+
+
+def format_review_prompt(requirement, prepared_code):
+    """用已前处理的代码块构造审查提示词（不再压缩代码）"""
     code_context = "\n\n".join(
         f"所属文件: {block['filename']}\n"
         f"代码:\n{block['content']}"
-        for idx, block in enumerate(related_code)
+        for block in prepared_code
     )
     
-    # 2. 构造提示词
     template = REVIEW_PROMPT_TEMPLATE
-    prompt = template.format(
+    return template.format(
         requirement=requirement,
         related_code=code_context
     )
-    
-    # 3. 调用LLM
-    try:
-        response = query_llm(prompt)
-        print("LLM response:", response.content)
-        parsed_output = parse_review_output(response.content)
-        
-    except Exception as e:
-        print(f"审查过程中出错: {str(e)}")
-        return None, None
-    
-    return parsed_output['review_process'], parsed_output['issues']
 
 
 def parse_review_output(response):
@@ -328,12 +1562,14 @@ def parse_review_output(response):
     }
 
 # ================= 需求反生成 =================
-def query_generated_requirement(related_code):
+def query_generated_requirement(related_code, use_cache=True, cache_path=None):
     """
     需求反生成
     
     参数:
         related_code: 相关代码块列表，每个代码块包含文件名、内容等信息
+        use_cache: 是否使用LLM回复缓存
+        cache_path: 缓存文件路径
         
     返回:
         generated_requirement: 审查过程
@@ -341,7 +1577,7 @@ def query_generated_requirement(related_code):
     # 1. 拼接相关代码
     code_context = "\n\n".join(
         f"所属文件: {block['filename']}\n"
-        f"代码:\n{block['content']}"
+        f"代码:\n{prepare_prompt_code(block['content'], block['filename'])}"
         for idx, block in enumerate(related_code)
     )
     
@@ -353,8 +1589,7 @@ def query_generated_requirement(related_code):
     
     # 3. 调用LLM
     try:
-        response = query_llm(prompt)
-        print("LLM response:", response.content)
+        response = query_llm(prompt, use_cache=use_cache, cache_path=cache_path, task="generate")
         output = response.content
         
     except Exception as e:
@@ -1,9 +1,17 @@
 import os
 import time
-from flask import Flask, json, render_template, request, jsonify
+import uuid
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, json, render_template, request, jsonify, stream_with_context
 import socket
-from utils import get_all_files_with_relative_paths, parse_markdown, split_code, count_lines_of_code, convert_doc_to_markdown
-from agent import query_generated_requirement, query_related_code, query_review_result
+from utils import get_all_files_with_relative_paths, parse_markdown, pack_code_files, split_code_units, pack_code_units, count_lines_of_code, convert_doc_to_markdown
+from agent import get_llm_gateway, get_single_flight_stats, get_compaction_stats, query_generated_requirement, query_related_code, query_related_code_batch, query_related_code_hierarchical, query_related_code_incremental, query_review_result, query_review_batch, stream_review_result, parse_review_output, normalize_code_file, ALIGN_BATCH_SIZE, ALIGN_CHUNK_TOKENS, ALIGN_HIERARCHICAL
+from llm_cache import get_project_cache_path, get_all_cache_stats
+from code_index import load_or_build_code_index
+from llm_metrics import get_llm_metrics
+from llm_scheduler import llm_priority, PRIORITY_BATCH
 import random
 import string
 from datetime import datetime, timedelta
@@ -370,13 +378,28 @@ def get_file_content():
         return jsonify({"status": "error", "message": f"读取文件内容时出错: {e}"}), 500
 
 # alignment and review
+def get_cache_options(data):
+    """从请求体中读取LLM缓存选项：useCache 为 false 时跳过缓存，提供 projectPath 时使用项目内缓存"""
+    project_path = data.get('projectPath')
+    return {
+        "use_cache": data.get('useCache', True),
+        "cache_path": get_project_cache_path(project_path) if project_path and os.path.isdir(project_path) else None
+    }
+
+def get_project_code_index(data, code_blocks):
+    """请求中提供 projectPath 时，使用（必要时重建）项目的代码词法索引"""
+    project_path = data.get('projectPath')
+    if not project_path or not os.path.isdir(project_path):
+        return None
+    return load_or_build_code_index(project_path, [normalize_code_file(block) for block in code_blocks])
+
 @app.route('/api/query-related-code', methods=['POST'])
 def query_related_code_endpoint():
     data = request.json
     requirement = data.get('requirement', '')
     code_files = data.get('codeFiles', [])
 
-    related_code = query_related_code(requirement, code_files, split_code=True)
+    related_code = query_related_code(requirement, code_files, split_code=True, **get_cache_options(data))
     # related_code = [{'filename': 'acme.c', 'content': 'int main() { return 0; }', 'start': 1, 'end': 5},
     #                 {'filename': 'acme.c', 'content': 'int main() { return 0; }', 'start': 10, 'end': 15},
     #                 {'filename': 'acme.c', 'content': 'int main() { return 0; }', 'start': 90, 'end': 95}]
@@ -390,20 +413,108 @@ def review_consistency_endpoint():
     requirement = data.get('requirement')
     related_code = data.get('relatedCode', [])
     
-    review_process, issues = query_review_result(requirement, related_code)
-    # review_process = "This is a mock review process. The code implementation matches the requirement."
-    # issues = "This is a mock issue list. No issues found."
+    review_process, issues = query_review_result(requirement, related_code, **get_cache_options(data))
     
     return jsonify({"reviewProcess":review_process, "issues": issues})
 
 
+def sse_event(event, data):
+    """格式化一条 Server-Sent Events 消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/review-consistency/stream', methods=['POST'])
+def review_consistency_stream_endpoint():
+    """
+    流式审查：通过 SSE 逐段推送模型生成的文本（token 事件），
+    生成结束后推送解析后的审查过程与问题单（result 事件），出错时推送 error 事件
+    """
+    data = request.json
+    requirement = data.get('requirement')
+    related_code = data.get('relatedCode', [])
+    cache_options = get_cache_options(data)
+
+    def generate():
+        parts = []
+        try:
+            for delta in stream_review_result(requirement, related_code, **cache_options):
+                parts.append(delta)
+                yield sse_event('token', {"content": delta})
+            parsed_output = parse_review_output("".join(parts))
+            yield sse_event('result', {"reviewProcess": parsed_output['review_process'], "issues": parsed_output['issues']})
+        except Exception as e:
+            print(f"审查过程中出错: {str(e)}")
+            yield sse_event('error', {"message": str(e)})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/review-batch', methods=['POST'])
+def review_batch_endpoint():
+    """
+    批量审查：并发审查多个需求点，结果按完成顺序返回并以 id 标识
+
+    请求体:
+        items: 审查项列表 [{"id", "requirement", "relatedCode"}]；或
+        projectPath + docFilename + alignmentIds: 从项目对齐文件中读取对应需求点的需求与代码
+        stream: 为 true 时通过 SSE 逐个推送（result / error 事件，最后推送 done 事件），否则全部完成后返回
+        maxWorkers: 并发审查数（可选）
+    """
+    data = request.json or {}
+    items = data.get('items')
+    if items is None:
+        project_path = data.get('projectPath')
+        doc_filename = data.get('docFilename')
+        if not project_path or not doc_filename or not os.path.isdir(project_path):
+            return jsonify({"status": "error", "message": "缺少审查项或项目对齐参数。"}), 400
+        alignments = read_alignments(project_path, doc_filename)
+        items = [
+            alignment_to_review_item(alignments[alignment_id])
+            for alignment_id in data.get('alignmentIds', [])
+            if alignment_id in alignments
+        ]
+    if any('id' not in item or 'requirement' not in item for item in items):
+        return jsonify({"status": "error", "message": "审查项缺少 id 或 requirement。"}), 400
+
+    # 批量审查作为后台任务排在交互式请求之后，并按项目公平分配并发额度
+    reviews = query_review_batch(items, max_workers=data.get('maxWorkers'), tenant=data.get('projectPath'),
+                                 **get_cache_options(data))
+
+    if not data.get('stream'):
+        results = {}
+        for item_id, review_process, issues in reviews:
+            results[item_id] = {"id": item_id, "reviewProcess": review_process, "issues": issues}
+        return jsonify({"status": "success", "results": [results[item['id']] for item in items]}), 200
+
+    def generate():
+        failed = 0
+        for item_id, review_process, issues in reviews:
+            if review_process is None:
+                failed += 1
+                yield sse_event('error', {"id": item_id, "message": "审查失败"})
+            else:
+                yield sse_event('result', {"id": item_id, "reviewProcess": review_process, "issues": issues})
+        yield sse_event('done', {"total": len(items), "failed": failed})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def alignment_to_review_item(alignment):
+    """将项目中的对齐关系转换为审查项"""
+    return {
+        "id": alignment['id'],
+        "requirement": "\n".join(doc_range.get('content', '') for doc_range in alignment.get('docRanges', [])),
+        "relatedCode": alignment.get('codeRanges', [])
+    }
+
+
 @app.route('/api/generate-requirement', methods=['POST'])
 def generate_requirement_endpoint():
     data = request.json
     related_code = data.get('relatedCode', [])
     
-    generate_requirement = query_generated_requirement(related_code)
-    # generate_requirement = "This is a mock generated requirement based on the provided code blocks."
+    generate_requirement = query_generated_requirement(related_code, **get_cache_options(data))
     
     return jsonify({"generatedRequirement":generate_requirement})
 
@@ -421,24 +532,51 @@ def parse_requirement():
 
     return jsonify({"requirementPoints": requirement_point_list})
 
+def parse_batch_size(data):
+    """读取请求中的 batchSize，非正整数时返回 None"""
+    batch_size = data.get('batchSize', ALIGN_BATCH_SIZE)
+    if isinstance(batch_size, bool) or not isinstance(batch_size, int) or batch_size <= 0:
+        return None
+    return batch_size
+
+
 @app.route('/api/auto-align', methods=['POST'])
 def auto_align():
     data = request.json
+    if parse_batch_size(data) is None:
+        return jsonify({"status": "error", "message": "batchSize 必须为正整数。"}), 400
+    # 整篇文档的自动对齐作为批量任务，排在单条对齐、需求反生成等交互式请求之后
+    with llm_priority(PRIORITY_BATCH, data.get('projectPath')):
+        return auto_align_requirements(data)
+
+
+def auto_align_requirements(data):
     requirements = data.get('requirements', '')
     code_files = data.get('codeFiles', [])
     
     # 解析需求文档成为需求点列表
     requirement_point_list = parse_markdown(requirements)
     
-    # 解析代码文件
-    code_blocks = []
-    for file in code_files:
-        code_block = split_code(file['name'], file['content'])
-        code_blocks.extend(code_block)
-
-    for point in requirement_point_list:
-        related_code = query_related_code(point, code_blocks)
-        point["associated_code"] = related_code # [{"filename":, "content":, "start_line":, "end_line":}]
+    # 两阶段模式：先按代码骨架定位相关结构，再发送选中结构的完整代码
+    if data.get('hierarchical', ALIGN_HIERARCHICAL):
+        for point in requirement_point_list:
+            point["associated_code"] = query_related_code_hierarchical(point, code_files, **get_cache_options(data))
+        return jsonify({"requirementPoints": requirement_point_list})
+
+    # 按 token 预算打包代码文件
+    code_blocks = pack_code_files(code_files, max_tokens=ALIGN_CHUNK_TOKENS)
+
+    # 批量模式：多个需求点打包进同一提示词，每个代码块对每批需求只发送一次
+    batch_size = parse_batch_size(data)
+    if batch_size > 1:
+        related_code_list = query_related_code_batch(requirement_point_list, code_blocks, batch_size=batch_size,
+                                                     index=get_project_code_index(data, code_blocks), **get_cache_options(data))
+        for point, related_code in zip(requirement_point_list, related_code_list):
+            point["associated_code"] = related_code
+    else:
+        for point in requirement_point_list:
+            related_code = query_related_code(point, code_blocks, **get_cache_options(data))
+            point["associated_code"] = related_code # [{"filename":, "content":, "start_line":, "end_line":}]
         
     return jsonify({"requirementPoints": requirement_point_list})
 
@@ -449,22 +587,18 @@ def align_single_requirement():
     code_files = data.get('codeFiles', [])
     
     requirement_point_list = [requirement]
+
+    if data.get('hierarchical', ALIGN_HIERARCHICAL):
+        related_code = query_related_code_hierarchical(requirement, code_files, **get_cache_options(data))
+        requirement["associated_code"] = related_code
+        return jsonify({"requirementPoint": requirement})
     
-    # 解析代码文件
-    code_blocks = []
-    for file in code_files:
-        code_block = split_code(file['name'], file['content'])
-        code_blocks.extend(code_block)
-
-    # for point in requirement_point_list:
-    #     def generate_random_string(length=10):
-    #         return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
-    #     random_string = generate_random_string()
-        
-    #     point["associated_code"] = [{"filename": "mock.cpp", "content": random_string, "start_line": 1, "end_line": 5}]
+    # 按 token 预算打包代码文件
+    code_blocks = pack_code_files(code_files, max_tokens=ALIGN_CHUNK_TOKENS)
 
+    index = get_project_code_index(data, code_blocks)
     for point in requirement_point_list:
-        related_code = query_related_code(point, code_blocks)
+        related_code = query_related_code(point, code_blocks, index=index, **get_cache_options(data))
         point["associated_code"] = related_code # [{"filename":, "content":, "start_line":, "end_line":}]
         
     return jsonify({"requirementPoint": requirement_point_list[0]})
@@ -481,10 +615,52 @@ def review_single_requirement():
     return jsonify({"result": 0})
 
 
+@app.route('/api/llm-status', methods=['GET'])
+def llm_status():
+    """大模型调用状态：各推理服务的自适应并发窗口、在途与排队请求数，缓存、相同请求合并与代码压缩统计"""
+    return jsonify({
+        "status": "success",
+        "endpoints": get_llm_gateway().stats(),
+        "caches": get_all_cache_stats(),
+        "single_flight": get_single_flight_stats(),
+        "compaction": get_compaction_stats()
+    })
+
+
+@app.route('/api/metrics', methods=['GET'])
+def llm_metrics():
+    """大模型调用遥测：按任务类型统计的调用次数、token 用量、排队等待与延迟分布、缓存命中，各优先级的排队深度，以及最近的调用明细"""
+    return jsonify({"status": "success", **get_llm_metrics().snapshot(), "scheduler": get_llm_gateway().stats()})
+
+
 def get_filename_without_extension(filename):
     """去掉文件名的扩展名"""
     return os.path.splitext(filename)[0]
 
+# 对齐文件（results/*.json）的读-改-写都需持有该锁，后台对齐任务与前端的增删改共用
+alignment_file_lock = threading.Lock()
+
+
+def get_alignments_file(project_path, doc_filename):
+    """指定需求文档对应的对齐文件路径"""
+    return os.path.join(project_path, 'results', f'{get_filename_without_extension(doc_filename)}.json')
+
+
+def write_alignments(alignments_file, data):
+    """原子写入对齐文件：先写入同目录的临时文件再替换，读取方不会看到写了一半的文件"""
+    directory = os.path.dirname(alignments_file)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.alignments-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+        os.replace(temp_path, alignments_file)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
 @app.route('/project/alignments', methods=['GET'])
 def get_alignments():
     """获取指定需求文档的对齐关系"""
@@ -499,10 +675,10 @@ def get_alignments():
     # 去掉文件扩展名
     doc_name_without_ext = get_filename_without_extension(doc_filename)
     alignments_file = os.path.join(project_path, 'results', f'{doc_name_without_ext}.json')
-    if not os.path.exists(alignments_file):
-        with open(alignments_file, 'w', encoding='utf-8') as f:
-            json.dump({}, f, indent=4, ensure_ascii=False)
-        return jsonify({"status": "success", "data": {}}), 200
+    with alignment_file_lock:
+        if not os.path.exists(alignments_file):
+            write_alignments(alignments_file, {})
+            return jsonify({"status": "success", "data": {}}), 200
 
     try:
         with open(alignments_file, 'r', encoding='utf-8') as f:
@@ -529,19 +705,12 @@ def add_alignment():
     doc_name_without_ext = get_filename_without_extension(doc_filename)
     alignments_file = os.path.join(results_dir, f'{doc_name_without_ext}.json')
 
-    data = {}
-    if os.path.exists(alignments_file):
-        with open(alignments_file, 'r', encoding='utf-8') as f:
-            try:
-                data = json.load(f)
-            except json.JSONDecodeError:
-                pass
-
-    data[new_alignment['id']] = new_alignment
-
     try:
-        with open(alignments_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        with alignment_file_lock:
+            # 文件损坏时报错而不是覆盖，避免丢失已保存的对齐关系
+            data = read_alignments(project_path, doc_filename, strict=True)
+            data[new_alignment['id']] = new_alignment
+            write_alignments(alignments_file, data)
         return jsonify({"status": "success"}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": f"写入对齐文件失败: {e}"}), 500
@@ -564,14 +733,11 @@ def delete_alignment():
         return jsonify({"status": "success", "message": "文件不存在，无需删除。"}), 200
 
     try:
-        with open(alignments_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-        if alignment_id in data:
-            del data[alignment_id]
-
-        with open(alignments_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        with alignment_file_lock:
+            data = read_alignments(project_path, doc_filename, strict=True)
+            if alignment_id in data:
+                del data[alignment_id]
+                write_alignments(alignments_file, data)
 
         return jsonify({"status": "success"}), 200
     except Exception as e:
@@ -603,6 +769,300 @@ def get_alignment_file():
         return jsonify({"status": "error", "message": f"读取对齐文件失败: {e}"}), 500
 
 
+# ================= 后台自动对齐任务 =================
+ALIGN_JOB_WORKERS = int(os.environ.get('ALIGN_JOB_WORKERS', 2))
+ALIGN_JOB_FILE = 'align_job.json'
+
+align_job_executor = ThreadPoolExecutor(max_workers=ALIGN_JOB_WORKERS)
+align_jobs = {}  # 项目路径 -> AlignmentJob
+align_jobs_lock = threading.Lock()
+
+
+class AlignmentJob:
+    """
+    项目级自动对齐任务：对项目中所有未对齐的需求点进行对齐，结果增量写入 results/*.json
+
+    realign 为 True 时，已自动对齐（且未被手动修改）的需求点也会重新对齐：
+    只查询内容发生变化的代码单元，其余单元复用上次的结果。
+    """
+
+    def __init__(self, project_path, batch_size=ALIGN_BATCH_SIZE, realign=False):
+        self.id = uuid.uuid4().hex
+        self.project_path = project_path
+        self.batch_size = batch_size
+        self.realign = realign
+        self.status = 'pending'  # pending / running / completed / cancelled / failed
+        self.total = 0
+        self.completed = 0
+        self.aligned = 0
+        self.current_doc = None
+        self.error = None
+        self.created_at = datetime.now().isoformat()
+        self.updated_at = self.created_at
+        self._cancel_event = threading.Event()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "realign": self.realign,
+            "total": self.total,
+            "completed": self.completed,
+            "aligned": self.aligned,
+            "current_doc": self.current_doc,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+    def save(self):
+        """将任务进度写入项目文件夹，服务重启后仍可查询"""
+        self.updated_at = datetime.now().isoformat()
+        with open(os.path.join(self.project_path, ALIGN_JOB_FILE), 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=4, ensure_ascii=False)
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def is_active(self):
+        return self.status in ('pending', 'running')
+
+    def run(self):
+        # 后台对齐任务的请求排在交互式请求之后，多个项目的任务之间轮转
+        with llm_priority(PRIORITY_BATCH, self.project_path):
+            self._run()
+
+    def _run(self):
+        try:
+            self.status = 'running'
+            self.save()
+
+            with open(os.path.join(self.project_path, 'metadata.json'), 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+            code_units = load_project_code_units(metadata)
+            cache_path = get_project_cache_path(self.project_path)
+            index = load_or_build_code_index(self.project_path, [
+                normalize_code_file(block) for block in pack_code_units(code_units, ALIGN_CHUNK_TOKENS)
+            ])
+
+            # 收集所有文档中未对齐的需求点（codeRanges为空或不存在），重新对齐时还包括自动对齐的需求点
+            pending = []
+            for doc_file in metadata.get('doc_files', []):
+                alignments = read_alignments(self.project_path, doc_file)
+                unaligned = [
+                    a for a in alignments.values()
+                    if not a.get('codeRanges') or (self.realign and is_auto_aligned(a))
+                ]
+                if unaligned:
+                    pending.append((doc_file, unaligned))
+            self.total = sum(len(unaligned) for _, unaligned in pending)
+            self.save()
+
+            for doc_file, unaligned in pending:
+                self.current_doc = doc_file
+                for i in range(0, len(unaligned), self.batch_size):
+                    if self._cancel_event.is_set():
+                        self.status = 'cancelled'
+                        return
+
+                    batch = unaligned[i:i + self.batch_size]
+                    points = [alignment_to_requirement_point(a) for a in batch]
+                    results = query_related_code_incremental(
+                        points, code_units,
+                        previous_states=[a.get('alignState') if is_auto_aligned(a) else None for a in batch],
+                        batch_size=self.batch_size, cache_path=cache_path, index=index
+                    )
+                    update_alignment_code_ranges(self.project_path, doc_file, {
+                        alignment['id']: result for alignment, result in zip(batch, results)
+                    })
+
+                    self.completed += len(batch)
+                    self.aligned += sum(1 for related_code, _ in results if related_code)
+                    self.save()
+
+            self.current_doc = None
+            self.status = 'completed'
+        except Exception as e:
+            print(f"自动对齐任务出错: {e}")
+            self.status = 'failed'
+            self.error = str(e)
+        finally:
+            self.save()
+
+
+def load_project_code_units(metadata):
+    """读取项目中的所有代码文件并拆分为打包单元（带内容哈希）"""
+    code_repo_path = metadata.get('code_repo')
+    code_files = []
+    for code_file in metadata.get('code_files', []):
+        with open(os.path.join(code_repo_path, code_file), 'r', encoding='utf-8', errors='replace') as f:
+            code_files.append({"name": code_file, "content": f.read()})
+    return split_code_units(code_files, max_tokens=ALIGN_CHUNK_TOKENS)
+
+
+def code_ranges_signature(code_ranges):
+    """代码范围的位置签名，用于判断自动对齐的结果是否被手动修改过"""
+    return [[code_range.get('filename'), code_range.get('start'), code_range.get('end')]
+            for code_range in code_ranges or []]
+
+
+def is_auto_aligned(alignment):
+    """需求点的代码范围是否仍为自动对齐的结果（有对齐状态且未被手动修改）"""
+    state = alignment.get('alignState')
+    return bool(state) and state.get('codeRanges') == code_ranges_signature(alignment.get('codeRanges'))
+
+
+def alignment_to_requirement_point(alignment):
+    """将对齐关系转换为对齐查询使用的需求点"""
+    return {
+        "id": alignment['id'],
+        "content": "\n".join(doc_range.get('content', '') for doc_range in alignment.get('docRanges', []))
+    }
+
+
+def read_alignments(project_path, doc_filename, strict=False):
+    """
+    读取指定需求文档的对齐文件，不存在时返回空字典
+
+    strict 为 False 时文件损坏也返回空字典（只读场景）；读-改-写时应传 True，
+    损坏时抛出 ValueError（JSON 解析错误），避免把空结果写回而丢失全部对齐关系
+    """
+    alignments_file = get_alignments_file(project_path, doc_filename)
+    if not os.path.exists(alignments_file):
+        return {}
+    with open(alignments_file, 'r', encoding='utf-8') as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            if strict:
+                raise
+            return {}
+
+
+def update_alignment_code_ranges(project_path, doc_filename, results_by_id):
+    """
+    将对齐结果写回对齐文件，只更新对应需求点的 codeRanges 与 alignState 字段
+
+    results_by_id: 需求点ID -> (相关代码块列表, 增量对齐状态)
+    """
+    with alignment_file_lock:
+        data = read_alignments(project_path, doc_filename, strict=True)
+        for alignment_id, (related_code, align_state) in results_by_id.items():
+            # 需求点可能在任务运行期间被用户删除或手动对齐，此时不覆盖
+            if alignment_id not in data:
+                continue
+            alignment = data[alignment_id]
+            if alignment.get('codeRanges') and not is_auto_aligned(alignment):
+                continue
+            alignment['codeRanges'] = [
+                {
+                    "filename": block['filename'],
+                    "start": block['start'],
+                    "end": block['end'],
+                    "content": block['content']
+                }
+                for block in related_code
+            ]
+            alignment['alignState'] = dict(align_state, codeRanges=code_ranges_signature(alignment['codeRanges']))
+        write_alignments(get_alignments_file(project_path, doc_filename), data)
+
+
+def get_align_job_status(project_path):
+    """获取项目的对齐任务状态：优先使用内存中的任务，否则读取持久化的进度"""
+    with align_jobs_lock:
+        job = align_jobs.get(project_path)
+    if job is not None:
+        return job.to_dict()
+
+    job_file = os.path.join(project_path, ALIGN_JOB_FILE)
+    if not os.path.exists(job_file):
+        return None
+    with open(job_file, 'r', encoding='utf-8') as f:
+        try:
+            status = json.load(f)
+        except ValueError:
+            return None
+    # 服务重启前未结束的任务视为中断，可通过 resume 继续
+    if status.get('status') in ('pending', 'running'):
+        status['status'] = 'interrupted'
+    return status
+
+
+def submit_align_job(project_path, batch_size, realign=False):
+    """提交对齐任务；项目已有运行中的任务时直接返回该任务"""
+    with align_jobs_lock:
+        job = align_jobs.get(project_path)
+        if job is not None and job.is_active():
+            return job
+        job = AlignmentJob(project_path, batch_size, realign)
+        align_jobs[project_path] = job
+    job.save()
+    align_job_executor.submit(job.run)
+    return job
+
+
+@app.route('/project/align-job', methods=['POST'])
+def start_align_job():
+    """
+    启动项目级自动对齐后台任务
+
+    请求体可选参数 realign: 为 true 时同时重新对齐已自动对齐的需求点（仅重新查询有变化的代码）
+    """
+    project_path = request.args.get('path')
+    if not project_path or not os.path.isfile(os.path.join(project_path, 'metadata.json')):
+        return jsonify({"status": "error", "message": "无效的项目路径。"}), 400
+
+    data = request.json or {}
+    batch_size = parse_batch_size(data)
+    if batch_size is None:
+        return jsonify({"status": "error", "message": "batchSize 必须为正整数。"}), 400
+    job = submit_align_job(project_path, batch_size, bool(data.get('realign')))
+    return jsonify({"status": "success", "job": job.to_dict()}), 200
+
+
+@app.route('/project/align-job', methods=['GET'])
+def get_align_job():
+    """查询项目自动对齐任务的进度"""
+    project_path = request.args.get('path')
+    if not project_path or not os.path.isdir(project_path):
+        return jsonify({"status": "error", "message": "无效的项目路径。"}), 400
+
+    return jsonify({"status": "success", "job": get_align_job_status(project_path)}), 200
+
+
+@app.route('/project/align-job/cancel', methods=['POST'])
+def cancel_align_job():
+    """取消项目的自动对齐任务（当前批次完成后停止，已完成的结果会保留）"""
+    project_path = request.args.get('path')
+    with align_jobs_lock:
+        job = align_jobs.get(project_path)
+    if job is None or not job.is_active():
+        return jsonify({"status": "error", "message": "没有正在运行的对齐任务。"}), 400
+
+    job.cancel()
+    return jsonify({"status": "success", "job": job.to_dict()}), 200
+
+
+@app.route('/project/align-job/resume', methods=['POST'])
+def resume_align_job():
+    """继续已取消、失败或中断的对齐任务：只处理剩余的未对齐需求点"""
+    project_path = request.args.get('path')
+    if not project_path or not os.path.isfile(os.path.join(project_path, 'metadata.json')):
+        return jsonify({"status": "error", "message": "无效的项目路径。"}), 400
+
+    previous = get_align_job_status(project_path)
+    if previous is None:
+        return jsonify({"status": "error", "message": "没有可继续的对齐任务。"}), 400
+
+    data = request.json or {}
+    batch_size = parse_batch_size(data)
+    if batch_size is None:
+        return jsonify({"status": "error", "message": "batchSize 必须为正整数。"}), 400
+    # 沿用上次任务的模式：重新对齐任务继续时仍只重新对齐自动对齐的需求点
+    job = submit_align_job(project_path, batch_size, bool(previous.get('realign')))
+    return jsonify({"status": "success", "job": job.to_dict()}), 200
+
+
 # 问题单相关API
 @app.route('/project/issues', methods=['GET'])
 def get_issues():
@@ -0,0 +1,248 @@
+"""
+端到端吞吐基准：在合成项目上运行自动对齐（/api/auto-align）与批量审查（/api/review-batch），
+统计请求吞吐、延迟分位数与 token 吞吐
+
+默认在进程内启动模拟推理服务（mock_llm_server.py），无需 GPU 即可离线测量性能改动的效果；
+通过 --api-base 可改为测量真实的推理服务。
+
+另有代码分块基准（--split-lines），在生成的大文件上测量 split_code 的耗时随文件规模的变化，不调用推理服务。
+
+用法:
+    python benchmark.py --files 20 --functions 10 --requirements 40 --latency 0.2 --tokens-per-second 50
+    python benchmark.py --split-lines 5000 20000 80000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+WORDS = [
+    "orbit", "attitude", "thrust", "sensor", "gyro", "telemetry", "command", "battery", "solar", "antenna",
+    "heater", "valve", "pressure", "temperature", "star", "tracker", "wheel", "momentum", "magnet", "torque",
+    "payload", "camera", "memory", "watchdog", "clock", "bus", "packet", "checksum", "filter", "mode",
+]
+
+
+def generate_function(rng, name, words):
+    """生成一个带注释的合成 C 函数"""
+    body = [f"/* 计算 {' '.join(words)} 相关的数据 */", f"int {name}(int input, int limit) {{"]
+    for i in range(rng.randint(6, 20)):
+        word = rng.choice(words)
+        body.append(f"    int {word}_{i} = input * {rng.randint(1, 9)} + limit;  // {word}")
+        if i % 4 == 3:
+            body.append(f"    if ({word}_{i} > limit) {{")
+            body.append(f"        {word}_{i} = limit;")
+            body.append("    }")
+    body.append(f"    return {words[0]}_0;")
+    body.append("}")
+    return body
+
+
+def generate_project(num_files, functions_per_file, num_requirements, seed=0):
+    """
+    生成合成项目
+
+    返回:
+        (代码文件列表 [{"name", "content"}], 需求文档 Markdown 文本)
+    """
+    rng = random.Random(seed)
+    code_files = []
+    functions = []
+    for file_index in range(num_files):
+        lines = ["#include <stdio.h>", f"#define MAX_LIMIT_{file_index} {rng.randint(10, 1000)}", ""]
+        for function_index in range(functions_per_file):
+            words = rng.sample(WORDS, 3)
+            name = f"{'_'.join(words)}_{file_index}_{function_index}"
+            functions.append((name, words))
+            lines.extend(generate_function(rng, name, words))
+            lines.append("")
+        code_files.append({"name": f"src/module_{file_index}.c", "content": "\n".join(lines) + "\n"})
+
+    sections = ["# 软件需求规格说明"]
+    for req_index in range(num_requirements):
+        name, words = rng.choice(functions)
+        sections.append(f"## 需求 {req_index + 1}")
+        sections.append(
+            f"软件应根据输入计算{words[0]}与{words[1]}的值，当结果超过上限时取上限值，"
+            f"并将{words[2]}的状态通过 {name} 上报。"
+        )
+    return code_files, "\n\n".join(sections) + "\n"
+
+
+def generate_large_file(num_lines, seed=0):
+    """生成约 num_lines 行的合成 C 文件（命名空间、结构体与大量函数）"""
+    rng = random.Random(seed)
+    lines = ["#include <stdio.h>", "namespace flight {", "struct state {", "    int mode;", "};"]
+    index = 0
+    while len(lines) < num_lines:
+        words = rng.sample(WORDS, 3)
+        lines.extend(generate_function(rng, f"{'_'.join(words)}_{index}", words))
+        lines.append("")
+        index += 1
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def benchmark_split(sizes, max_tokens, repeat=3):
+    """测量 split_code 在不同规模文件上的耗时（取多次运行的最小值）"""
+    from utils import split_code
+    results = []
+    for num_lines in sizes:
+        content = generate_large_file(num_lines)
+        timings = []
+        chunks = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            chunks = split_code("src/large.c", content, max_length=max_tokens)
+            timings.append(time.perf_counter() - start)
+        lines = content.count("\n")
+        results.append({
+            "lines": lines,
+            "chunks": len(chunks),
+            "seconds": min(timings),
+            "lines_per_second": lines / min(timings) if min(timings) else 0.0,
+        })
+    return results
+
+
+def print_split_report(results):
+    print(f"{'行数':>10}{'分块数':>8}{'耗时':>12}{'行/秒':>14}")
+    for result in results:
+        print(f"{result['lines']:>12}{result['chunks']:>8}{result['seconds']:>12.3f}{result['lines_per_second']:>14.0f}")
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(phase, wall_time, calls):
+    """汇总一个阶段的调用明细"""
+    latencies = [call["latency"] for call in calls if not call.get("cache_hit")]
+    prompt_tokens = sum(call.get("prompt_tokens") or 0 for call in calls)
+    completion_tokens = sum(call.get("completion_tokens") or 0 for call in calls)
+    return {
+        "phase": phase,
+        "wall_time": wall_time,
+        "llm_requests": len(latencies),
+        "errors": sum(1 for call in calls if call.get("error")),
+        "requests_per_second": len(latencies) / wall_time if wall_time else 0.0,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "tokens_per_second": (prompt_tokens + completion_tokens) / wall_time if wall_time else 0.0,
+        "completion_tokens_per_second": completion_tokens / wall_time if wall_time else 0.0,
+    }
+
+
+def format_seconds(value):
+    return "-" if value is None else f"{value:.3f}s"
+
+
+def print_report(results):
+    print()
+    print(f"{'阶段':<14}{'耗时':>10}{'请求数':>8}{'错误':>6}{'请求/秒':>10}{'p50':>10}{'p95':>10}{'token/秒':>12}{'生成token/秒':>14}")
+    for result in results:
+        print(f"{result['phase']:<16}{result['wall_time']:>10.2f}{result['llm_requests']:>8}{result['errors']:>6}"
+              f"{result['requests_per_second']:>10.2f}{format_seconds(result['latency_p50']):>10}"
+              f"{format_seconds(result['latency_p95']):>10}{result['tokens_per_second']:>12.1f}"
+              f"{result['completion_tokens_per_second']:>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="自动对齐与批量审查的端到端吞吐基准")
+    parser.add_argument("--api-base", help="真实推理服务地址（多个以逗号分隔）；不指定时在进程内启动模拟推理服务")
+    parser.add_argument("--files", type=int, default=10, help="合成项目的代码文件数")
+    parser.add_argument("--functions", type=int, default=10, help="每个代码文件的函数数")
+    parser.add_argument("--requirements", type=int, default=20, help="需求点数量")
+    parser.add_argument("--batch-size", type=int, default=8, help="自动对齐时每个提示词打包的需求点数量")
+    parser.add_argument("--review-workers", type=int, default=None, help="批量审查的并发数")
+    parser.add_argument("--latency", type=float, default=0.1, help="模拟推理服务每个请求的固定延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="模拟推理服务的生成速度")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="模拟推理服务同时处理的请求数上限")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟推理服务返回 503 的比例")
+    parser.add_argument("--replicas", type=int, default=1, help="启动的模拟推理服务副本数，请求在各副本之间负载均衡")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="以 JSON 格式输出结果")
+    parser.add_argument("--split-lines", type=int, nargs="+", help="只运行代码分块基准，指定生成文件的行数")
+    parser.add_argument("--split-tokens", type=int, default=8000, help="代码分块基准的 token 预算")
+    args = parser.parse_args()
+
+    if args.split_lines:
+        results = benchmark_split(args.split_lines, args.split_tokens)
+        if args.json:
+            print(json.dumps(results, ensure_ascii=False, indent=2))
+        else:
+            print_split_report(results)
+        return 0
+
+    # 推理服务地址需在导入 agent 之前设置
+    if args.api_base:
+        os.environ["API_BASE_URL"] = args.api_base
+    else:
+        from mock_llm_server import start_mock_server
+        base_urls = []
+        for _ in range(max(1, args.replicas)):
+            _, base_url = start_mock_server(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                                            max_concurrency=args.max_concurrency, error_rate=args.error_rate)
+            base_urls.append(base_url)
+        os.environ["API_BASE_URL"] = ",".join(base_urls)
+
+    import llm_metrics
+    from app import app
+
+    code_files, requirements = generate_project(args.files, args.functions, args.requirements, args.seed)
+    client = app.test_client()
+    results = []
+
+    # 1. 自动对齐（跳过缓存，保证每次都实际调用推理服务）
+    llm_metrics._metrics = llm_metrics.LLMMetrics(recent=1000000)
+    start = time.monotonic()
+    response = client.post('/api/auto-align', json={
+        "requirements": requirements,
+        "codeFiles": code_files,
+        "batchSize": args.batch_size,
+        "useCache": False,
+    })
+    wall_time = time.monotonic() - start
+    if response.status_code != 200:
+        print(f"自动对齐失败: HTTP {response.status_code}", file=sys.stderr)
+        return 1
+    points = response.get_json()["requirementPoints"]
+    results.append(summarize("auto-align", wall_time, llm_metrics.get_llm_metrics().snapshot()["recent"]))
+
+    # 2. 批量审查已对齐的需求点
+    items = [
+        {"id": point["id"], "requirement": str(point["content"]), "relatedCode": point["associated_code"]}
+        for point in points if point.get("associated_code")
+    ]
+    llm_metrics._metrics = llm_metrics.LLMMetrics(recent=1000000)
+    start = time.monotonic()
+    response = client.post('/api/review-batch', json={
+        "items": items,
+        "maxWorkers": args.review_workers,
+        "useCache": False,
+    })
+    wall_time = time.monotonic() - start
+    if response.status_code != 200:
+        print(f"批量审查失败: HTTP {response.status_code}", file=sys.stderr)
+        return 1
+    results.append(summarize("review-batch", wall_time, llm_metrics.get_llm_metrics().snapshot()["recent"]))
+
+    aligned = sum(1 for point in points if point.get("associated_code"))
+    if args.json:
+        print(json.dumps({"requirement_points": len(points), "aligned": aligned, "results": results},
+                         ensure_ascii=False, indent=2))
+    else:
+        print(f"需求点: {len(points)}，已对齐: {aligned}，审查: {len(items)}")
+        print_report(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+import os
+import re
+import json
+import math
+import hashlib
+from collections import Counter
+
+# 对齐前按词法相关度保留的候选代码块数量，0 表示不过滤（全部发送）
+ALIGN_TOP_K = int(os.environ.get("ALIGN_TOP_K", 20))
+CODE_INDEX_FILENAME = "code_index.json"
+CODE_INDEX_VERSION = 1
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+CJK_PATTERN = re.compile(r'[\u4e00-\u9fff]+')
+CAMEL_PATTERN = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+')
+
+
+def split_identifier(identifier):
+    """拆分标识符：snake_case 与 camelCase 均拆为小写子词，并保留完整标识符"""
+    parts = []
+    for piece in identifier.split('_'):
+        parts.extend(part.lower() for part in CAMEL_PATTERN.findall(piece))
+    full = identifier.lower().strip('_')
+    if full and full not in parts:
+        parts.append(full)
+    return [part for part in parts if len(part) > 1 or part == full]
+
+
+def tokenize(text):
+    """
+    将代码或需求文本切分为检索词
+
+    - 标识符按 camelCase / snake_case 拆分
+    - 中文（通常出现在注释和需求中）按字的二元组切分
+    """
+    tokens = []
+    for identifier in IDENTIFIER_PATTERN.findall(text):
+        tokens.extend(split_identifier(identifier))
+    for run in CJK_PATTERN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def chunk_key(code_file):
+    """代码块的内容标识：文件名 + 带行号内容的哈希"""
+    payload = code_file["name"] + "\0" + code_file["numberedContent"]
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class BM25Index:
+    """代码块的 BM25 词法索引"""
+
+    def __init__(self, keys, term_freqs, lengths):
+        self.keys = keys
+        self.term_freqs = term_freqs
+        self.lengths = lengths
+        self.avgdl = sum(lengths) / len(lengths) if lengths else 0.0
+        self.doc_freqs = Counter()
+        for tf in term_freqs:
+            self.doc_freqs.update(tf.keys())
+        self._positions = {key: i for i, key in enumerate(keys)}
+
+    @classmethod
+    def build(cls, code_files):
+        """基于代码块列表（{"name", "numberedContent"}）建立索引"""
+        keys, term_freqs, lengths = [], [], []
+        for code_file in code_files:
+            tokens = tokenize(code_file["name"] + "\n" + code_file["numberedContent"])
+            keys.append(chunk_key(code_file))
+            term_freqs.append(Counter(tokens))
+            lengths.append(len(tokens))
+        return cls(keys, term_freqs, lengths)
+
+    def covers(self, code_files):
+        """索引是否包含全部给定代码块"""
+        return all(chunk_key(code_file) in self._positions for code_file in code_files)
+
+    def scores(self, query, code_files):
+        """计算查询文本与给定代码块的 BM25 得分"""
+        query_terms = set(tokenize(query))
+        n = len(self.keys)
+        idf = {
+            term: math.log(1 + (n - self.doc_freqs[term] + 0.5) / (self.doc_freqs[term] + 0.5))
+            for term in query_terms if self.doc_freqs[term]
+        }
+        scores = []
+        for code_file in code_files:
+            position = self._positions.get(chunk_key(code_file))
+            if position is None:
+                scores.append(0.0)
+                continue
+            tf = self.term_freqs[position]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[position] / (self.avgdl or 1))
+            scores.append(sum(
+                weight * tf[term] * (BM25_K1 + 1) / (tf[term] + norm)
+                for term, weight in idf.items() if tf[term]
+            ))
+        return scores
+
+    def top_k(self, query, code_files, k):
+        """
+        选出与查询最相关的 k 个代码块的下标（按输入顺序返回）
+
+        k 为 0、代码块数量不超过 k 或查询与所有代码块都没有词法重叠时，返回全部下标。
+        """
+        if not k or len(code_files) <= k:
+            return list(range(len(code_files)))
+        scores = self.scores(query, code_files)
+        if not any(scores):
+            return list(range(len(code_files)))
+        ranked = sorted(range(len(code_files)), key=lambda i: scores[i], reverse=True)
+        return sorted(i for i in ranked[:k] if scores[i] > 0)
+
+    def to_dict(self):
+        return {
+            "version": CODE_INDEX_VERSION,
+            "chunks": [
+                {"key": key, "length": length, "tf": dict(tf)}
+                for key, length, tf in zip(self.keys, self.lengths, self.term_freqs)
+            ]
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        chunks = data.get("chunks", [])
+        return cls(
+            [chunk["key"] for chunk in chunks],
+            [Counter(chunk["tf"]) for chunk in chunks],
+            [chunk["length"] for chunk in chunks],
+        )
+
+
+def get_code_index_path(project_path):
+    """项目级词法索引文件路径（与 metadata.json 同级）"""
+    return os.path.join(project_path, CODE_INDEX_FILENAME)
+
+
+def load_or_build_code_index(project_path, code_files):
+    """
+    读取项目的词法索引；索引不存在、版本不符或与当前代码块不一致时重新建立并保存
+
+    参数:
+        project_path: 项目路径
+        code_files: 代码块列表（{"name", "numberedContent"}）
+    """
+    index_path = get_code_index_path(project_path)
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == CODE_INDEX_VERSION:
+                index = BM25Index.from_dict(data)
+                if len(index.keys) == len(code_files) and index.covers(code_files):
+                    return index
+        except (json.JSONDecodeError, KeyError, OSError) as e:
+            print(f"读取代码索引失败，重新建立: {e}")
+
+    index = BM25Index.build(code_files)
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump(index.to_dict(), f, ensure_ascii=False)
+    return index
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# 缓存配置
+LLM_CACHE_FILE = os.environ.get("LLM_CACHE_FILE", "llm_cache.sqlite")
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+PROJECT_CACHE_FILENAME = "llm_cache.sqlite"
+
+
+def make_cache_key(model, messages, temperature, top_p, **extra_params):
+    """
+    根据 (模型, 对话消息, temperature, top_p) 计算内容寻址的缓存键
+
+    extra_params 为其他影响生成结果的参数（如 max_tokens、response_format），仅在提供时参与计算。
+    """
+    payload = {"model": model, "messages": messages, "temperature": temperature, "top_p": top_p}
+    payload.update(extra_params)
+    payload = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LLMCache:
+    """
+    基于 SQLite 的大模型回复持久化缓存
+
+    以内容哈希为键，总大小超过上限时按最近最少使用（LRU）顺序淘汰。
+    """
+
+    def __init__(self, path, max_bytes=LLM_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        cache_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY,"
+            " model TEXT,"
+            " response TEXT,"
+            " size INTEGER,"
+            " created_at REAL,"
+            " last_access REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_access ON llm_cache(last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+
+    def get(self, key):
+        """读取缓存，命中时刷新访问时间；未命中返回 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model, response):
+        """写入缓存，并在超出容量时淘汰最久未访问的条目"""
+        size = len(response.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self._total_bytes -= old[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, model, response, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, size, now, now),
+            )
+            self._total_bytes += size
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """按 LRU 顺序淘汰条目直到总大小不超过上限（调用方需持有锁）"""
+        while self._total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM llm_cache ORDER BY last_access ASC LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+            for key, size in rows:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._total_bytes -= size
+                self.evictions += 1
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+            self._total_bytes = 0
+
+    def stats(self):
+        """返回缓存命中统计"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "path": self.path,
+                "entries": entries,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_llm_cache(path=None):
+    """获取指定路径的缓存实例（同一路径在进程内共享），默认使用全局缓存文件"""
+    path = os.path.abspath(path or LLM_CACHE_FILE)
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = LLMCache(path)
+            _caches[path] = cache
+        return cache
+
+
+def get_project_cache_path(project_path):
+    """项目级缓存文件路径（位于项目文件夹内）"""
+    return os.path.join(project_path, PROJECT_CACHE_FILENAME)
+
+
+def get_all_cache_stats():
+    """返回进程内所有已打开缓存的统计信息"""
+    with _caches_lock:
+        caches = list(_caches.values())
+    return [cache.stats() for cache in caches]
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import bisect
+import random
+import threading
+from collections import Counter, deque
+
+# 调试日志：设置 LLM_DEBUG_LOG 后按采样率记录完整的提示词与模型输出（JSON Lines）
+LLM_DEBUG_LOG = os.environ.get("LLM_DEBUG_LOG", "")
+LLM_DEBUG_SAMPLE_RATE = float(os.environ.get("LLM_DEBUG_SAMPLE_RATE", 0.01))
+LLM_METRICS_RECENT = int(os.environ.get("LLM_METRICS_RECENT", 100))
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+
+class Histogram:
+    """固定分桶的直方图，分位数按桶内线性插值估计"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+    def to_dict(self):
+        cumulative = 0
+        buckets = {}
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            cumulative += bucket_count
+            buckets[str(bound)] = cumulative
+        buckets["+Inf"] = self.count
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+class TaskMetrics:
+    """单类任务（对齐、审查等）的计数器与直方图"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.shared = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.models = Counter()
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queue_wait = Histogram(LATENCY_BUCKETS)
+        self.prompt_tokens_hist = Histogram(TOKEN_BUCKETS)
+        self.completion_tokens_hist = Histogram(TOKEN_BUCKETS)
+
+    def to_dict(self):
+        requests = self.calls + self.cache_hits + self.shared
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "cache_hits": self.cache_hits,
+            "shared": self.shared,
+            "cache_hit_rate": self.cache_hits / requests if requests else 0.0,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "models": dict(self.models),
+            "latency_seconds": self.latency.to_dict(),
+            "queue_wait_seconds": self.queue_wait.to_dict(),
+            "prompt_tokens_per_call": self.prompt_tokens_hist.to_dict(),
+            "completion_tokens_per_call": self.completion_tokens_hist.to_dict(),
+        }
+
+
+class LLMMetrics:
+    """
+    大模型调用遥测：按任务类型汇总调用次数、token 用量、排队等待与延迟分布及缓存命中情况，
+    并保留最近若干次调用的明细
+    """
+
+    def __init__(self, recent=LLM_METRICS_RECENT):
+        self.started_at = time.time()
+        self._tasks = {}
+        self._queue_wait_by_priority = {}
+        self._recent = deque(maxlen=recent)
+        self._lock = threading.Lock()
+
+    def _task(self, task):
+        metrics = self._tasks.get(task)
+        if metrics is None:
+            metrics = TaskMetrics()
+            self._tasks[task] = metrics
+        return metrics
+
+    def record_call(self, task, model, latency, queue_wait, prompt_tokens=None, completion_tokens=None,
+                    error=None, priority=None, endpoint=None):
+        """记录一次实际发送到推理服务的调用"""
+        with self._lock:
+            metrics = self._task(task)
+            metrics.calls += 1
+            metrics.models[model] += 1
+            metrics.latency.observe(latency)
+            metrics.queue_wait.observe(queue_wait)
+            if priority is not None:
+                histogram = self._queue_wait_by_priority.get(priority)
+                if histogram is None:
+                    histogram = Histogram(LATENCY_BUCKETS)
+                    self._queue_wait_by_priority[priority] = histogram
+                histogram.observe(queue_wait)
+            if error:
+                metrics.errors += 1
+            if prompt_tokens is not None:
+                metrics.prompt_tokens += prompt_tokens
+                metrics.prompt_tokens_hist.observe(prompt_tokens)
+            if completion_tokens is not None:
+                metrics.completion_tokens += completion_tokens
+                metrics.completion_tokens_hist.observe(completion_tokens)
+            self._recent.append({
+                "time": time.time(),
+                "task": task,
+                "model": model,
+                "latency": latency,
+                "queue_wait": queue_wait,
+                "priority": priority,
+                "endpoint": endpoint,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "cache_hit": False,
+                "error": error,
+            })
+
+    def record_cache_hit(self, task, model):
+        """记录一次缓存命中（未发送到推理服务）"""
+        with self._lock:
+            self._task(task).cache_hits += 1
+            self._recent.append({"time": time.time(), "task": task, "model": model, "cache_hit": True})
+
+    def record_shared(self, task):
+        """记录一次与正在执行的相同请求合并的调用"""
+        with self._lock:
+            self._task(task).shared += 1
+
+    def snapshot(self):
+        with self._lock:
+            tasks = {task: metrics.to_dict() for task, metrics in self._tasks.items()}
+            queue_wait_by_priority = {
+                priority: histogram.to_dict() for priority, histogram in self._queue_wait_by_priority.items()
+            }
+            recent = list(self._recent)
+        totals = {
+            key: sum(task[key] for task in tasks.values())
+            for key in ("calls", "errors", "cache_hits", "shared", "prompt_tokens", "completion_tokens")
+        }
+        return {
+            "uptime_seconds": time.time() - self.started_at,
+            "totals": totals,
+            "tasks": tasks,
+            "queue_wait_by_priority": queue_wait_by_priority,
+            "recent": recent,
+        }
+
+
+_metrics = LLMMetrics()
+_debug_log_lock = threading.Lock()
+
+
+def get_llm_metrics():
+    """获取进程级共享的遥测实例"""
+    return _metrics
+
+
+def log_llm_call(task, prompt, output, **fields):
+    """按采样率将完整的提示词和模型输出写入调试日志（未设置 LLM_DEBUG_LOG 时不记录）"""
+    if not LLM_DEBUG_LOG or random.random() >= LLM_DEBUG_SAMPLE_RATE:
+        return
+    record = {"time": time.time(), "task": task, "prompt": prompt, "output": output}
+    record.update(fields)
+    try:
+        with _debug_log_lock, open(LLM_DEBUG_LOG, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"写入LLM调试日志时出错: {str(e)}")
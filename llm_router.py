@@ -0,0 +1,197 @@
+import os
+import time
+import hashlib
+import threading
+
+# 多推理服务负载均衡配置
+LLM_HEALTH_CHECK_INTERVAL = float(os.environ.get("LLM_HEALTH_CHECK_INTERVAL", 10))  # 主动健康检查间隔（秒），0 表示关闭
+LLM_HEALTH_CHECK_TIMEOUT = float(os.environ.get("LLM_HEALTH_CHECK_TIMEOUT", 5))
+LLM_EJECT_FAILURES = int(os.environ.get("LLM_EJECT_FAILURES", 3))  # 连续失败多少次后摘除
+LLM_EJECT_SECONDS = float(os.environ.get("LLM_EJECT_SECONDS", 30))  # 摘除时长，期间健康检查通过可提前恢复
+LLM_AFFINITY_PREFIX_CHARS = int(os.environ.get("LLM_AFFINITY_PREFIX_CHARS", 1024))  # 前缀亲和使用的提示词前缀长度
+LLM_AFFINITY_SLACK = int(os.environ.get("LLM_AFFINITY_SLACK", 4))  # 亲和节点比最空闲节点多出的在途请求上限
+LATENCY_EWMA_ALPHA = 0.2
+
+
+def parse_base_urls(value):
+    """解析逗号分隔的推理服务地址列表"""
+    return [url.strip().rstrip('/') for url in value.split(',') if url.strip()]
+
+
+def make_affinity_key(text, prefix_chars=LLM_AFFINITY_PREFIX_CHARS):
+    """取提示词前缀计算亲和键：前缀相同的请求发往同一推理服务，以复用其前缀缓存（KV cache）"""
+    if not text or prefix_chars <= 0:
+        return None
+    return hashlib.sha1(text[:prefix_chars].encode('utf-8')).hexdigest()
+
+
+class Endpoint:
+    """单个推理服务的负载与健康状态"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.outstanding = 0
+        self.latency = None  # 按 token 归一化延迟的指数滑动平均
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.last_error = None
+
+    def is_available(self, now):
+        return now >= self.ejected_until
+
+    def to_dict(self, now):
+        return {
+            "outstanding": self.outstanding,
+            "latency_per_token": self.latency,
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "healthy": self.is_available(now),
+            "ejected_for_seconds": max(0.0, self.ejected_until - now),
+            "ejections": self.ejections,
+            "last_error": self.last_error,
+        }
+
+
+class EndpointRouter:
+    """
+    多推理服务（如多个 vLLM 副本）之间的负载均衡
+
+    - 默认选择在途请求最少的节点，相同时选择归一化延迟较低的节点
+    - 带亲和键的请求按一致性哈希（rendezvous hashing）固定发往同一节点，以复用前缀缓存；
+      该节点明显比其他节点繁忙时（超出 LLM_AFFINITY_SLACK）退回到最少在途请求的节点
+    - 连续失败达到 LLM_EJECT_FAILURES 次或健康检查失败的节点被摘除一段时间，
+      后台健康检查通过后恢复；所有节点都被摘除时仍在全部节点中选择，避免请求全部失败
+    """
+
+    def __init__(self, base_urls, probe=None, health_check_interval=LLM_HEALTH_CHECK_INTERVAL,
+                 eject_failures=LLM_EJECT_FAILURES, eject_seconds=LLM_EJECT_SECONDS,
+                 affinity_slack=LLM_AFFINITY_SLACK):
+        if not base_urls:
+            raise ValueError("至少需要一个推理服务地址")
+        self.endpoints = {base_url: Endpoint(base_url) for base_url in base_urls}
+        self.probe = probe
+        self.health_check_interval = health_check_interval
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self.affinity_slack = affinity_slack
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._health_thread = None
+
+    @property
+    def base_urls(self):
+        return list(self.endpoints)
+
+    def select(self, affinity_key=None, exclude=()):
+        """
+        选择一个推理服务并计入其在途请求，调用方需在请求结束后调用 finish
+
+        参数:
+            affinity_key: 前缀亲和键，为 None 时只按负载选择
+            exclude: 尽量避开的节点（如重试时已失败的节点）
+        """
+        self._ensure_health_check()
+        now = time.monotonic()
+        with self._lock:
+            endpoints = [e for e in self.endpoints.values() if e.base_url not in exclude] or list(self.endpoints.values())
+            candidates = [e for e in endpoints if e.is_available(now)] or endpoints
+            least_loaded = min(candidates, key=lambda e: (e.outstanding, e.latency or 0.0))
+            endpoint = least_loaded
+            if affinity_key is not None and len(candidates) > 1:
+                preferred = max(candidates, key=lambda e: _rendezvous_weight(affinity_key, e.base_url))
+                if preferred.outstanding <= least_loaded.outstanding + self.affinity_slack:
+                    endpoint = preferred
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint.base_url
+
+    def finish(self, base_url, latency=None, tokens=None, error=None):
+        """
+        请求结束后更新节点状态
+
+        参数:
+            latency: 请求耗时（秒），失败时可为 None
+            tokens: 请求的总 token 数，用于归一化延迟
+            error: 节点故障（连接失败、5xx 等）时为异常名称，None 表示节点正常
+        """
+        with self._lock:
+            endpoint = self.endpoints.get(base_url)
+            if endpoint is None:
+                return
+            endpoint.outstanding -= 1
+            if error:
+                self._record_failure(endpoint, error)
+                return
+            endpoint.consecutive_failures = 0
+            if latency is not None:
+                sample = latency / max(tokens or 1, 1)
+                if endpoint.latency is None:
+                    endpoint.latency = sample
+                else:
+                    endpoint.latency += LATENCY_EWMA_ALPHA * (sample - endpoint.latency)
+
+    def _record_failure(self, endpoint, error):
+        """记录一次失败，连续失败达到阈值时摘除节点（调用方需持有锁）"""
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        endpoint.last_error = error
+        if endpoint.consecutive_failures >= self.eject_failures and len(self.endpoints) > 1:
+            self._eject(endpoint)
+
+    def _eject(self, endpoint):
+        now = time.monotonic()
+        if endpoint.is_available(now):
+            endpoint.ejections += 1
+            print(f"推理服务 {endpoint.base_url} 不可用，暂时摘除: {endpoint.last_error}")
+        endpoint.ejected_until = now + self.eject_seconds
+
+    def check_health(self):
+        """对所有节点执行一次健康检查：失败的节点被摘除，通过的节点立即恢复"""
+        if self.probe is None:
+            return
+        for base_url in self.base_urls:
+            try:
+                self.probe(base_url)
+            except Exception as e:
+                with self._lock:
+                    endpoint = self.endpoints[base_url]
+                    endpoint.last_error = type(e).__name__
+                    if len(self.endpoints) > 1:
+                        self._eject(endpoint)
+            else:
+                with self._lock:
+                    endpoint = self.endpoints[base_url]
+                    if not endpoint.is_available(time.monotonic()):
+                        print(f"推理服务 {base_url} 健康检查通过，恢复使用")
+                    endpoint.consecutive_failures = 0
+                    endpoint.ejected_until = 0.0
+
+    def _ensure_health_check(self):
+        """多节点时在首次选择节点时启动后台健康检查线程"""
+        if (self._health_thread is not None or self.probe is None or len(self.endpoints) < 2
+                or self.health_check_interval <= 0):
+            return
+        with self._lock:
+            if self._health_thread is None:
+                self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+                self._health_thread.start()
+
+    def _health_loop(self):
+        while not self._stop_event.wait(self.health_check_interval):
+            self.check_health()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {base_url: endpoint.to_dict(now) for base_url, endpoint in self.endpoints.items()}
+
+    def close(self):
+        self._stop_event.set()
+
+
+def _rendezvous_weight(key, base_url):
+    return hashlib.sha1(f"{key}\0{base_url}".encode('utf-8')).digest()
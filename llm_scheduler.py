@@ -0,0 +1,246 @@
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+# 自适应并发控制配置
+LLM_LIMIT_INITIAL = int(os.environ.get("LLM_LIMIT_INITIAL", 8))
+LLM_LIMIT_MIN = int(os.environ.get("LLM_LIMIT_MIN", 1))
+LLM_LIMIT_MAX = int(os.environ.get("LLM_LIMIT_MAX", 64))
+LLM_LATENCY_TOLERANCE = float(os.environ.get("LLM_LATENCY_TOLERANCE", 2.0))
+LLM_LATENCY_WINDOW = int(os.environ.get("LLM_LATENCY_WINDOW", 20))  # 计算延迟中位数的最近请求数
+LLM_BACKOFF_FACTOR = 0.5
+LLM_BACKOFF_INTERVAL = 1.0  # 两次减半之间的最小间隔（秒）
+
+# 请求优先级：交互式请求（用户点击触发）优先于后台批量任务
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+# 当前请求的 (优先级, 租户)，租户通常为项目路径，用于批量任务在项目之间公平分配
+_request_priority = contextvars.ContextVar("llm_request_priority", default=(PRIORITY_INTERACTIVE, None))
+
+
+@contextmanager
+def llm_priority(priority, tenant=None):
+    """在该上下文中发起的大模型请求使用指定的优先级和租户"""
+    token = _request_priority.set((priority, tenant))
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+def current_llm_priority():
+    """返回当前上下文的 (优先级, 租户)"""
+    return _request_priority.get()
+
+
+def map_in_context(executor, fn, iterable):
+    """与 executor.map 相同，但每个任务在提交线程的上下文副本中执行（保留请求优先级）"""
+    tasks = [(contextvars.copy_context(), item) for item in iterable]
+    return executor.map(lambda task: task[0].run(fn, task[1]), tasks)
+
+
+def submit_in_context(executor, fn, *args):
+    """与 executor.submit 相同，但任务在提交线程的上下文副本中执行（保留请求优先级）"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD（加性增、乘性减）自适应并发限制器
+
+    - 请求延迟（按提示词与生成 token 总数归一化）保持在基线附近时，每完成一个窗口的请求并发上限加 1
+    - 延迟明显升高，或出现 429 / 5xx / 超时时，并发上限减半
+    单个请求的归一化延迟随输出长度波动很大，因此比较的是最近 LLM_LATENCY_WINDOW 个请求的中位数，
+    基线取该中位数的长期最小值；不同任务类型（对齐请求输出极短，评审请求输出很长）分别维护窗口和基线，
+    避免一类任务的基线误判另一类任务为过载。
+    这样同一套代码既能跑满大型 GPU 服务器，也不会压垮小型推理服务。
+
+    排队的请求按优先级放行：交互式请求总是先于批量请求；批量请求按租户（项目）轮转，
+    避免一个大项目的后台任务占满所有并发额度。
+    """
+
+    def __init__(self, initial_limit=LLM_LIMIT_INITIAL, min_limit=LLM_LIMIT_MIN,
+                 max_limit=LLM_LIMIT_MAX, latency_tolerance=LLM_LATENCY_TOLERANCE,
+                 backoff_factor=LLM_BACKOFF_FACTOR, latency_window=LLM_LATENCY_WINDOW):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff_factor = backoff_factor
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        self.latency_window = max(1, latency_window)
+        self.baselines = {}  # 任务类型 -> 无负载时归一化延迟中位数的估计
+        self._samples = {}  # 任务类型 -> 最近的归一化延迟
+        self.backoffs = 0
+        self.completed = 0
+        self._last_backoff = 0.0
+        self._interactive_queue = deque()
+        self._batch_queues = {}  # 租户 -> 等待队列
+        self._batch_tenants = deque()  # 有等待请求的租户，按轮转顺序排列
+        self._cond = threading.Condition()
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, tenant=None):
+        """按优先级排队，等待获得并发额度，返回排队等待的秒数"""
+        start = time.monotonic()
+        waiter = {"granted": False}
+        with self._cond:
+            if priority == PRIORITY_BATCH:
+                queue = self._batch_queues.get(tenant)
+                if queue is None:
+                    queue = deque()
+                    self._batch_queues[tenant] = queue
+                    self._batch_tenants.append(tenant)
+                queue.append(waiter)
+            else:
+                self._interactive_queue.append(waiter)
+            self._dispatch()
+            while not waiter["granted"]:
+                self._cond.wait()
+        return time.monotonic() - start
+
+    def _dispatch(self):
+        """在并发上限内按优先级放行排队的请求（调用方需持有锁）"""
+        granted = False
+        while self.in_flight < int(self.limit):
+            waiter = self._next_waiter()
+            if waiter is None:
+                break
+            waiter["granted"] = True
+            self.in_flight += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _next_waiter(self):
+        if self._interactive_queue:
+            return self._interactive_queue.popleft()
+        if not self._batch_tenants:
+            return None
+        # 批量请求在租户之间轮转
+        tenant = self._batch_tenants.popleft()
+        queue = self._batch_queues[tenant]
+        waiter = queue.popleft()
+        if queue:
+            self._batch_tenants.append(tenant)
+        else:
+            del self._batch_queues[tenant]
+        return waiter
+
+    def release(self, latency=None, tokens=None, overloaded=False, task=None):
+        """
+        请求结束后归还并发额度并调整上限
+
+        参数:
+            latency: 请求耗时（秒），请求失败时可为 None
+            tokens: 请求的 token 总数（提示词 + 生成），用于归一化延迟
+            overloaded: 是否出现过载信号（429 / 5xx / 超时）
+            task: 任务类型，每种任务类型单独维护延迟基线
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if overloaded:
+                self._backoff()
+            elif latency is not None:
+                self._on_success(task, latency / max(tokens or 1, 1))
+            self._dispatch()
+
+    def _on_success(self, task, sample):
+        self.completed += 1
+        samples = self._samples.get(task)
+        if samples is None:
+            samples = self._samples[task] = []
+        samples.append(sample)
+        if len(samples) == self.latency_window:
+            # 每满一个窗口判断一次，之后清空窗口，下一次判断只使用之后的请求
+            median = sorted(samples)[len(samples) // 2]
+            samples.clear()
+            baseline = self.baselines.get(task, median)
+            # 基线取中位数的长期最小值，并缓慢上浮以适应负载变化
+            baseline = min(baseline * 1.01, median)
+            self.baselines[task] = baseline
+            if median > baseline * self.latency_tolerance:
+                self._backoff()
+                return
+        # 每个窗口（limit 个请求）增加 1
+        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+    def _backoff(self):
+        # 同一个窗口内的多个过载信号只减一次，避免上限瞬间降到最低
+        now = time.monotonic()
+        if now - self._last_backoff < LLM_BACKOFF_INTERVAL:
+            return
+        self._last_backoff = now
+        self.limit = max(self.min_limit, self.limit * self.backoff_factor)
+        self.backoffs += 1
+
+    def stats(self):
+        with self._cond:
+            batch_depth = sum(len(queue) for queue in self._batch_queues.values())
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "queue_depth": len(self._interactive_queue) + batch_depth,
+                "queue_depth_by_priority": {
+                    PRIORITY_INTERACTIVE: len(self._interactive_queue),
+                    PRIORITY_BATCH: batch_depth,
+                },
+                "batch_queue_depth_by_tenant": {
+                    str(tenant): len(queue) for tenant, queue in self._batch_queues.items()
+                },
+                "baseline_latency_per_token": {str(task): baseline for task, baseline in self.baselines.items()},
+                "completed": self.completed,
+                "backoffs": self.backoffs,
+            }
+
+
+class SingleFlight:
+    """
+    相同请求合并：同一个键的请求正在执行时，后到的请求不再重复执行，而是等待并共享同一个结果
+    """
+
+    def __init__(self):
+        self.executed = 0
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """执行 fn()；若相同 key 的调用正在进行，则等待其结果（包括异常）"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self.executed += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "executed": self.executed,
+                "shared": self.shared,
+            }
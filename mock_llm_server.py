@@ -0,0 +1,278 @@
+"""
+本地 OpenAI 兼容的模拟推理服务，用于在没有 GPU 服务器时离线测试和测量对齐、审查流程的性能
+
+根据提示词内容生成确定性的回复：
+- 对齐（单条 / 批量）：按需求与代码行的词法重叠选出行号区间，返回合法的对齐 JSON
+- 骨架对齐：返回与需求有词法重叠的骨架条目编号
+- 审查 / 汇总：返回带分隔符的审查分析过程和问题单
+- 其他（如需求反生成）：返回一段描述文本
+
+用法:
+    python mock_llm_server.py --port 8001 --latency 0.2 --tokens-per-second 50
+"""
+import re
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from code_index import tokenize
+
+MOCK_MODEL_NAME = "mock-llm"
+REVIEW_SEPARATOR = "===== 审查分析过程结束 ====="
+MAX_MOCK_INTERVALS = 3
+
+NUMBERED_LINE_PATTERN = re.compile(r'^(\d+): ?(.*)$')
+SKELETON_ENTRY_PATTERN = re.compile(r'^\[(S\d+)\] \d+-\d+: (.*)$')
+BATCH_REQUIREMENT_PATTERN = re.compile(r'^### 需求 (R\d+)$')
+
+
+def count_tokens(text):
+    """粗略估计 token 数（约 4 个字符一个 token），避免依赖 tiktoken 的词表下载"""
+    return max(1, len(text) // 4)
+
+
+def section(prompt, start_marker, end_marker=None):
+    """截取提示词中两个标记之间的内容"""
+    start = prompt.find(start_marker)
+    if start < 0:
+        return ""
+    start += len(start_marker)
+    end = prompt.find(end_marker, start) if end_marker else -1
+    return prompt[start:end] if end >= 0 else prompt[start:]
+
+
+def match_intervals(requirement, code):
+    """选出与需求有词法重叠的代码行，合并为行号区间（最多 MAX_MOCK_INTERVALS 个，按重叠数排序）"""
+    terms = set(tokenize(requirement))
+    intervals = []
+    for line in code.splitlines():
+        numbered = NUMBERED_LINE_PATTERN.match(line)
+        if not numbered:
+            continue
+        line_num = int(numbered.group(1))
+        score = len(terms & set(tokenize(numbered.group(2))))
+        if not score:
+            continue
+        if intervals and intervals[-1][1] == line_num - 1:
+            intervals[-1][1] = line_num
+            intervals[-1][2] += score
+        else:
+            intervals.append([line_num, line_num, score])
+    best = sorted(intervals, key=lambda interval: -interval[2])[:MAX_MOCK_INTERVALS]
+    return [[start, end] for start, end, _ in sorted(best)]
+
+
+def build_mock_reply(prompt):
+    """根据提示词类型生成确定性的回复文本"""
+    if "## 代码骨架如下：" in prompt:
+        requirement = section(prompt, "## 需求如下：", "## 代码骨架如下：")
+        terms = set(tokenize(requirement))
+        selected = []
+        for line in section(prompt, "## 代码骨架如下：").splitlines():
+            entry = SKELETON_ENTRY_PATTERN.match(line)
+            if entry and terms & set(tokenize(entry.group(2))):
+                selected.append(entry.group(1))
+        return json.dumps({"related_blocks": selected})
+
+    if "## 代码如下：" in prompt:
+        requirement = section(prompt, "## 需求如下：", "## 代码如下：")
+        code = section(prompt, "## 代码如下：")
+        if "### 需求 R" in requirement:
+            current_id = None
+            parts = {}
+            for line in requirement.splitlines():
+                header = BATCH_REQUIREMENT_PATTERN.match(line.strip())
+                if header:
+                    current_id = header.group(1)
+                    parts[current_id] = []
+                elif current_id:
+                    parts[current_id].append(line)
+            related = {req_id: match_intervals("\n".join(lines), code) for req_id, lines in parts.items()}
+            return json.dumps({"related_code": related})
+        return json.dumps({"related_code": match_intervals(requirement, code)})
+
+    digest = int(hashlib.sha1(prompt.encode('utf-8')).hexdigest(), 16)
+    if REVIEW_SEPARATOR in prompt:
+        files = sorted(set(re.findall(r'所属文件: (.*)', prompt)))
+        process = "\n".join(
+            [f"1. 需求与代码的对应关系：相关实现位于 {', '.join(files) or '给定代码'}。",
+             "2. 逐段审查：功能、算法、参数与变量取值均已核对。",
+             "3. 潜在风险：未发现明显的技术风险。"] * 3
+        )
+        if digest % 4 == 0:
+            issues = (f"在[{files[0] if files else '代码'}]的[第1行]处，程序实现是[模拟实现]，而需求是[模拟需求]，"
+                      f"实现与需求不一致，原因是[模拟分析]。")
+        else:
+            issues = "无不一致问题"
+        return f"审查分析过程\n{process}\n{REVIEW_SEPARATOR}\n问题单\n{issues}"
+
+    return "该代码实现了数据的读取、校验与处理功能，并在异常情况下返回错误码。" * (1 + digest % 3)
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """可配置延迟、生成速度、并发容量与错误率的模拟推理服务"""
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.1, tokens_per_second=100.0, max_concurrency=0, error_rate=0.0):
+        super().__init__(address, MockLLMHandler)
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency > 0 else None
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+
+    def should_fail(self):
+        with self._lock:
+            self.requests += 1
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.errors += 1
+                return True
+            return False
+
+    def generation_time(self, completion_tokens):
+        return self.latency + (completion_tokens / self.tokens_per_second if self.tokens_per_second > 0 else 0)
+
+    def acquire_slot(self):
+        if self._slots:
+            self._slots.acquire()
+
+    def release_slot(self):
+        if self._slots:
+            self._slots.release()
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self.send_json(200, {"object": "list", "data": [{"id": MOCK_MODEL_NAME, "object": "model"}]})
+        elif self.path.rstrip('/').endswith('/health'):
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {"error": {"message": "not found"}})
+            return
+        if self.server.should_fail():
+            self.send_json(503, {"error": {"message": "mock server overloaded", "type": "server_error"}})
+            return
+
+        prompt = "\n".join(str(message.get("content", "")) for message in request.get("messages", []))
+        content = build_mock_reply(prompt)
+        prompt_tokens = count_tokens(prompt)
+        completion_tokens = count_tokens(content)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        model = request.get("model", MOCK_MODEL_NAME)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        self.server.acquire_slot()
+        try:
+            if request.get("stream"):
+                self.stream_reply(completion_id, model, content, usage,
+                                  (request.get("stream_options") or {}).get("include_usage"))
+                return
+            time.sleep(self.server.generation_time(completion_tokens))
+        finally:
+            self.server.release_slot()
+
+        self.send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": usage,
+        })
+
+    def stream_reply(self, completion_id, model, content, usage, include_usage):
+        """以 SSE 方式按生成速度逐段返回内容"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send_chunk(delta, finish_reason=None, chunk_usage=None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if delta is not None else [],
+            }
+            if chunk_usage:
+                chunk["usage"] = chunk_usage
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
+        time.sleep(self.server.latency)
+        pieces = [content[i:i + 16] for i in range(0, len(content), 16)]
+        for piece in pieces:
+            send_chunk({"content": piece})
+            if self.server.tokens_per_second > 0:
+                time.sleep(count_tokens(piece) / self.server.tokens_per_second)
+        send_chunk({}, finish_reason="stop")
+        if include_usage:
+            send_chunk(None, chunk_usage=usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def start_mock_server(host="127.0.0.1", port=0, **options):
+    """在后台线程中启动模拟推理服务，返回 (server, base_url)"""
+    server = MockLLMServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容的模拟推理服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.1, help="每个请求的固定延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0, help="每个请求的生成速度，0 表示不限")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="同时处理的请求数上限，0 表示不限")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 503 的请求比例")
+    args = parser.parse_args()
+
+    server = MockLLMServer((args.host, args.port), latency=args.latency,
+                           tokens_per_second=args.tokens_per_second,
+                           max_concurrency=args.max_concurrency, error_rate=args.error_rate)
+    print(f"模拟推理服务已启动: http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
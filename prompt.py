@@ -3,14 +3,14 @@ ALIGN_PROMPT_TEMPLATE = """你是一位精通航天领域软件系统和C/C++编
 给定一段Markdown格式的需求，以及一个带行号的代码文件的内容，请你帮我找出与该需求最相关的代码段。严格按照以下JSON格式返回结果：
 ```json
 {{
-  "related_code": [[start1, end1], [start2, end2], ...],
+  "related_code": [[start1, end1], [start2, end2], ...]
 }}
 ```
 # 提示
 1.直接返回结果，不要输出其他思考和说明内容。例如，如果代码中的第5行到第10行，和第20到30行与需求相关，则返回：
 ```json
 {{
-  "related_code": [[5, 10], [20, 30], ...],
+  "related_code": [[5, 10], [20, 30]]
 }}
 ```
 如果没有相关的代码，则返回：
@@ -29,6 +29,49 @@ ALIGN_PROMPT_TEMPLATE = """你是一位精通航天领域软件系统和C/C++编
 """
 
 
+BATCH_ALIGN_PROMPT_TEMPLATE = """你是一位精通航天领域软件系统和C/C++编程的资深专家。
+# 任务
+给定多条Markdown格式的需求（每条需求有一个编号），以及一个带行号的代码文件的内容，请你帮我分别找出与每条需求最相关的代码段。严格按照以下JSON格式返回结果，键为需求编号：
+```json
+{{
+  "related_code": {{
+    "R1": [[start1, end1], [start2, end2]],
+    "R2": []
+  }}
+}}
+```
+# 提示
+1.直接返回结果，不要输出其他思考和说明内容。每条需求都必须出现在结果中，如果某条需求没有相关的代码，则该需求对应空列表。
+2.相关指的是代码实现了需求中描述的功能或逻辑。如果需求中有表格或公式，请查找与之相关的代码行号。如果需求中有多个相关代码段，请全部返回，不要遗漏。
+
+# 输入
+## 需求如下：
+{req_content}
+\n## 代码如下：
+{code_content}
+"""
+
+
+SKELETON_ALIGN_PROMPT_TEMPLATE = """你是一位精通航天领域软件系统和C/C++编程的资深专家。
+# 任务
+给定一段Markdown格式的需求，以及若干代码文件的骨架（只包含函数、结构体等代码结构的签名及其行号范围，以及函数体之外的声明语句，每条前有编号），请你帮我找出可能与该需求相关的代码结构和语句。严格按照以下JSON格式返回其编号：
+```json
+{{
+  "related_blocks": ["S1", "S5"]
+}}
+```
+# 提示
+1.直接返回结果，不要输出其他思考和说明内容。如果没有相关的代码，则返回空列表。
+2.相关指的是代码实现了需求中描述的功能或逻辑，或定义了需求中涉及的参数、常量和数据结构。只根据签名无法确定时宁可多选，不要遗漏。
+
+# 输入
+## 需求如下：
+{req_content}
+\n## 代码骨架如下：
+{skeleton_content}
+"""
+
+
 REVIEW_PROMPT_TEMPLATE = """
 # 任务说明
 作为航天软件质量审查专家，请执行以下任务：
@@ -63,6 +106,31 @@ REVIEW_PROMPT_TEMPLATE = """
 """
 
 
+REVIEW_REDUCE_PROMPT_TEMPLATE = """
+# 任务说明
+作为航天软件质量审查专家，同一条需求的相关代码较多，已被拆分为 {group_count} 组分别审查。请汇总各组的审查结果，给出该需求的整体审查结论：
+1. 合并各组的审查分析过程，保留关键的代码位置引用，去除重复内容
+2. 合并各组的问题单，去除重复问题；某组认为缺失的功能如已在其他组的代码中实现，则不应作为问题
+
+# 需求内容
+{requirement}
+
+# 各组审查结果
+{partial_reviews}
+
+# 输出要求
+请输出以下两部分内容：
+1.审查分析过程
+2.问题单
+- 按照以下格式列出所有不一致问题：
+在[文件名]的[函数名/行号]处，程序实现是[具体代码实现]，而需求是[需求描述]，实现与需求不一致，原因是[技术分析]。
+- 如果有多个不一致点，请依次列出，点与点之间用换行分隔
+- 如果没有不一致点，请输出“无不一致问题”
+
+两部分内容严格使用以下分隔符进行分割：===== 审查分析过程结束 =====
+"""
+
+
 GENERATE_PROMPT_TEMPLATE = """
 # 任务说明
 你是一位精通航天领域软件系统和C/C++编程的资深专家。请你根据以下代码，生成描述该代码功能的需求片段，要求如下：
@@ -0,0 +1,42 @@
+/**
+ * 以 POST 方式请求 Server-Sent Events 接口，逐个解析事件并交给 onEvent 处理
+ * （EventSource 只支持 GET，审查接口需要提交请求体，因此用 fetch 读取响应流）
+ * @param {string} url - 接口地址
+ * @param {Object} body - 请求体
+ * @param {Function} onEvent - 每收到一个事件时调用 (event, data)，可返回 Promise，处理完成后才解析下一个事件
+ * @returns {Promise<void>} 响应流结束时完成
+ */
+async function postEventStream(url, body, onEvent) {
+    const response = await fetch(url, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(body)
+    });
+    if (!response.ok) {
+        throw new Error(`HTTP ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // 事件之间以空行分隔
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let event = 'message';
+            let data = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) event = line.slice(6).trim();
+                else if (line.startsWith('data:')) data += line.slice(5).trim();
+            });
+            await onEvent(event, data ? JSON.parse(data) : {});
+        }
+    }
+}
@@ -146,24 +146,34 @@ const app = createApp({
 
                 reviewProgress.value.total = unreviewed.length;
 
-                for (const { docFile, alignment } of unreviewed) {
-                    reviewProgress.value.current++;
-
-                    // 生成mock审查结果
-                    await generateMockReview(docFile, alignment);
+                // 按需求文档分组，由服务端并发审查，结果按完成顺序逐个返回
+                const unreviewedByDoc = {};
+                unreviewed.forEach(({ docFile, alignment }) => {
+                    (unreviewedByDoc[docFile] = unreviewedByDoc[docFile] || []).push(alignment);
+                });
 
-                    // 实时更新统计数据
+                for (const [docFile, alignments] of Object.entries(unreviewedByDoc)) {
+                    const alignmentsById = Object.fromEntries(alignments.map(alignment => [alignment.id, alignment]));
+                    // 批量审查接口以 SSE 逐个返回结果（postEventStream 见 event-stream.js）
+                    await postEventStream('/api/review-batch', {
+                        projectPath: projectPath.value,
+                        docFilename: docFile,
+                        alignmentIds: alignments.map(alignment => alignment.id),
+                        stream: true
+                    }, async (event, data) => {
+                        if (event !== 'result' && event !== 'error') return;
+                        reviewProgress.value.current++;
+                        const alignment = alignmentsById[data.id];
+                        if (event === 'error') {
+                            ElMessage.warning(`审查失败: ${alignment.name}`);
+                            return;
+                        }
+                        await saveReviewResult(docFile, alignment, data);
+                        if (docFile === selectedDocFile.value) {
+                            await fetchAlignments();
+                        }
+                    });
                     await fetchAllAlignments();
-                    
-                    // 如果当前审查的对齐关系属于当前选中的文档，实时更新右侧面板
-                    if (docFile === selectedDocFile.value) {
-                        await fetchAlignments();
-                    }
-                    
-                    ElMessage.info(`已审查: ${alignment.name}`);
-
-                    // 添加延迟以模拟处理时间
-                    await new Promise(resolve => setTimeout(resolve, 800));
                 }
 
                 // 重新加载所有对齐数据和问题单
@@ -181,110 +191,35 @@ const app = createApp({
             }
         };
 
-        const generateMockReview = async (docFile, alignment) => {
-            // 生成mock审查思考过程
-            const requirementContent = alignment.docRanges && alignment.docRanges[0] ? alignment.docRanges[0].content : '';
-            const codeContent = alignment.codeRanges && alignment.codeRanges[0] ? alignment.codeRanges[0].content : '';
-
-            let reviewThoughts = `## 审查思考过程\n\n`;
-            reviewThoughts += `### 需求分析\n`;
-            reviewThoughts += `需求点"${alignment.name}"描述了以下功能要求：\n`;
-            reviewThoughts += `${requirementContent.substring(0, 200)}...\n\n`;
-
-            reviewThoughts += `### 代码实现分析\n`;
-            reviewThoughts += `对应的代码实现位于文件 \`${alignment.codeRanges[0].filename}\` 第${alignment.codeRanges[0].start}-${alignment.codeRanges[0].end}行。\n\n`;
-
-            // 根据内容生成不同的审查结论
-            let hasIssue = Math.random() < 0.3; // 30%概率生成问题单
-            let reviewConclusion = '';
-
-            if (requirementContent.includes('表格') || requirementContent.includes('数据')) {
-                reviewConclusion = '代码实现了基本的数据结构定义，符合需求中对表格数据处理的要求。';
-                if (hasIssue) {
-                    reviewConclusion += ' 但缺少数据验证和错误处理机制。';
-                }
-            } else if (requirementContent.includes('公式') || requirementContent.includes('计算')) {
-                reviewConclusion = '代码实现了相应的计算函数，数学逻辑基本正确。';
-                if (hasIssue) {
-                    reviewConclusion += ' 但需要考虑边界条件和异常情况的处理。';
-                }
-            } else {
-                reviewConclusion = '代码实现与需求描述基本一致，功能覆盖度良好。';
-                if (hasIssue) {
-                    reviewConclusion += ' 但代码注释不够详细，可维护性有待提升。';
-                }
-            }
-
-            reviewThoughts += `### 审查结论\n${reviewConclusion}\n`;
-
-            // 更新对齐关系，只添加审查标志和思考过程
+        // 保存审查结果：更新对齐关系的审查标志和思考过程，存在不一致问题时生成问题单
+        const saveReviewResult = async (docFile, alignment, result) => {
             const updatedAlignment = {
                 ...alignment,
                 isReviewed: true, // 设置审查标志位
-                reviewThoughts: reviewThoughts // 记录审查思考过程
+                reviewThoughts: result.reviewProcess // 记录审查思考过程
             };
-
-            // 保存审查结果
             await axios.post(
                 `/project/alignments?path=${encodeURIComponent(projectPath.value)}&doc_filename=${encodeURIComponent(docFile)}`,
                 updatedAlignment
             );
 
-            // 如果有问题，生成问题单并保存到issues.json
-            if (hasIssue) {
-                await generateIssueToFile(alignment, reviewConclusion);
+            const issues = (result.issues || '').trim();
+            if (issues && !issues.includes('无不一致问题')) {
+                await generateIssueToFile(docFile, alignment, issues);
             }
-
-            console.log(`生成审查结果: ${alignment.name}`);
         };
 
         // 生成问题单并保存到issues.json文件
-        const generateIssueToFile = async (alignment, reviewConclusion) => {
-            const issueId = crypto.randomUUID();
-            const requirementContent = alignment.docRanges && alignment.docRanges[0] ? alignment.docRanges[0].content : '';
-
-            // Mock问题等级（随机生成）
-            const levels = ['high', 'medium', 'low'];
-            const level = levels[Math.floor(Math.random() * levels.length)];
-
-            // Mock问题概述（根据需求内容生成）
-            const summaryOptions = [
-                '代码实现与需求描述存在差异',
-                '功能实现不够完整',
-                '缺少必要的错误处理机制',
-                '代码注释不够详细',
-                '性能优化空间较大',
-                '安全性考虑不足',
-                '用户体验有待改进',
-                '数据验证逻辑缺失',
-                '接口设计不够规范',
-                '配置参数需要调整'
-            ];
-
-            let summary;
-            if (requirementContent.includes('用户') || requirementContent.includes('登录') || requirementContent.includes('认证')) {
-                summary = '用户认证功能存在安全隐患';
-            } else if (requirementContent.includes('数据库') || requirementContent.includes('连接')) {
-                summary = '数据库连接配置需要优化';
-            } else if (requirementContent.includes('接口') || requirementContent.includes('API')) {
-                summary = 'API接口实现不完整';
-            } else if (requirementContent.includes('文件') || requirementContent.includes('上传')) {
-                summary = '文件处理功能需要完善';
-            } else if (requirementContent.includes('权限') || requirementContent.includes('访问')) {
-                summary = '权限控制机制不够严格';
-            } else {
-                // 随机选择一个问题概述
-                summary = summaryOptions[Math.floor(Math.random() * summaryOptions.length)];
-            }
-
+        const generateIssueToFile = async (docFile, alignment, description) => {
+            const firstLine = description.split('\n').find(line => line.trim()) || description;
             const newIssue = {
-                id: issueId,
-                level: level, // Mock的问题等级
-                summary: summary, // Mock的问题概述
-                description: reviewConclusion, // 问题详细描述
+                id: crypto.randomUUID(),
+                level: 'medium', // 默认等级，由人工确认时调整
+                summary: firstLine.length > 50 ? `${firstLine.substring(0, 50)}...` : firstLine,
+                description: description, // 问题详细描述
                 status: 'unconfirmed', // 固定状态：初始为"未确认"
                 alignmentId: alignment.id, // 关联的对齐关系ID
-                relatedDocFile: selectedDocFile.value,
+                relatedDocFile: docFile,
                 relatedRequirementId: alignment.id, // 保持向后兼容
                 createdDate: new Date().toISOString(),
                 updatedDate: new Date().toISOString()
@@ -295,8 +230,6 @@ const app = createApp({
                 `/project/issues?path=${encodeURIComponent(projectPath.value)}`,
                 newIssue
             );
-
-            console.log(`生成问题单: ${summary}`);
         };
 
         // 加载所有文档的对齐数据用于统计
@@ -603,7 +536,7 @@ const app = createApp({
         /***********************
          * 自动对齐功能
          ***********************/
-        const startAutoAlignment = async () => {
+        const startAutoAlignment = async (realign = false) => {
             if (isAutoAligning.value) {
                 ElMessage.warning('自动对齐正在进行中，请稍候...');
                 return;
@@ -619,105 +552,79 @@ const app = createApp({
                 return;
             }
 
-            isAutoAligning.value = true;
-            ElMessage.info('开始自动对齐，正在扫描未对齐的需求点...');
-
             try {
-                // 扫描所有文档中未对齐的需求点
-                let totalUnalignedCount = 0;
-                let processedCount = 0;
-
-                for (const docFile of projectFiles.value.doc_files) {
-                    const unalignedCount = await processUnalignedRequirements(docFile);
-                    totalUnalignedCount += unalignedCount;
-                    processedCount += unalignedCount;
-
-                    // 实时更新统计数据 - 触发响应式更新
-                    await nextTick();
-                }
-
-                // 重新加载所有对齐数据以更新统计信息
-                await fetchAllAlignments();
-
-                if (totalUnalignedCount === 0) {
-                    ElMessage.info('所有需求点都已对齐，无需处理');
-                } else {
-                    ElMessage.success(`自动对齐完成！共处理 ${processedCount} 个未对齐需求点`);
+                // 对齐任务在服务端后台执行，关闭或刷新页面不会中断
+                // realign 为 true 时同时重新对齐已自动对齐的需求点，服务端只重新查询内容变化的代码
+                const response = await axios.post(`/project/align-job?path=${encodeURIComponent(projectPath.value)}`, {
+                    realign: realign === true
+                });
+                if (response.data.status !== 'success') {
+                    ElMessage.error(`启动自动对齐失败: ${response.data.message}`);
+                    return;
                 }
+                isAutoAligning.value = true;
+                ElMessage.info('开始自动对齐，正在扫描未对齐的需求点...');
+                pollAlignmentJob();
             } catch (error) {
-                console.error('自动对齐过程中出现错误:', error);
+                console.error('启动自动对齐失败:', error);
                 ElMessage.error(`自动对齐失败: ${error.message}`);
-            } finally {
-                isAutoAligning.value = false;
-                alignmentProgress.value = { current: 0, total: 0 };
             }
         };
 
-        const processUnalignedRequirements = async (docFile) => {
+        const cancelAutoAlignment = async () => {
             try {
-                const alignmentResponse = await axios.get(`/project/alignments?path=${encodeURIComponent(projectPath.value)}&doc_filename=${encodeURIComponent(docFile)}`);
-                const existingAlignments = alignmentResponse.data.status === 'success' ? Object.values(alignmentResponse.data.data || {}) : [];
-
-                // 找到所有未对齐的需求点（codeRanges为空或不存在）
-                const unalignedRequirements = existingAlignments.filter(alignment =>
-                    !alignment.codeRanges || alignment.codeRanges.length === 0
-                );
-
-                alignmentProgress.value.total += unalignedRequirements.length;
-
-                for (const requirement of unalignedRequirements) {
-                    alignmentProgress.value.current++;
+                await axios.post(`/project/align-job/cancel?path=${encodeURIComponent(projectPath.value)}`);
+                ElMessage.info('正在取消自动对齐，当前批次完成后停止');
+            } catch (error) {
+                console.error('取消自动对齐失败:', error);
+                ElMessage.error(`取消自动对齐失败: ${error.message}`);
+            }
+        };
 
-                    // 为未对齐的需求点生成mock代码对齐
-                    await addMockCodeToRequirement(docFile, requirement);
+        // 轮询服务端对齐任务进度，对齐结果由服务端增量写入
+        const pollAlignmentJob = async () => {
+            try {
+                const response = await axios.get(`/project/align-job?path=${encodeURIComponent(projectPath.value)}`);
+                const job = response.data.job;
+                if (!job) {
+                    isAutoAligning.value = false;
+                    return;
+                }
 
-                    // 实时更新统计数据
+                if (job.completed !== alignmentProgress.value.current) {
                     await fetchAllAlignments();
-                    ElMessage.info(`已对齐需求点: ${requirement.name}`);
-
-                    await new Promise(resolve => setTimeout(resolve, 500));
+                    await fetchAlignments();
                 }
+                alignmentProgress.value = { current: job.completed, total: job.total };
 
-                return unalignedRequirements.length;
-            } catch (error) {
-                console.error(`处理文档 ${docFile} 时出错:`, error);
-                throw error;
-            }
-        };
-
-        const addMockCodeToRequirement = async (docFile, requirement) => {
-            const randomCodeFile = projectFiles.value.code_files[Math.floor(Math.random() * projectFiles.value.code_files.length)];
-            const startLine = Math.floor(Math.random() * 50) + 1;
-            const endLine = startLine + Math.floor(Math.random() * 20) + 5;
-            let mockCode = `// Mock代码段 - 对应需求: ${requirement.name}\n`;
-            const updatedAlignment = {
-                ...requirement,
-                codeRanges: [{
-                    filename: randomCodeFile,
-                    start: startLine,
-                    end: endLine,
-                    content: mockCode
-                }]
-            };
+                if (job.status === 'pending' || job.status === 'running') {
+                    isAutoAligning.value = true;
+                    setTimeout(pollAlignmentJob, 1000);
+                    return;
+                }
 
-            try {
-                await axios.post(
-                    `/project/alignments?path=${encodeURIComponent(projectPath.value)}&doc_filename=${encodeURIComponent(docFile)}`,
-                    updatedAlignment
-                );
+                // 仅在本页面跟踪过的任务结束时提示（页面加载时查询到的历史任务不提示）
+                const wasAligning = isAutoAligning.value;
+                isAutoAligning.value = false;
+                alignmentProgress.value = { current: 0, total: 0 };
+                if (!wasAligning) return;
+                await fetchAllAlignments();
+                await fetchAlignments();
 
-                // 如果当前选中的是这个文档，更新前端显示
-                if (selectedDocFile.value === docFile) {
-                    const index = alignmentResults.value.findIndex(a => a.id === requirement.id);
-                    if (index > -1) {
-                        alignmentResults.value[index] = updatedAlignment;
+                if (job.status === 'completed') {
+                    if (job.total === 0) {
+                        ElMessage.info('所有需求点都已对齐，无需处理');
+                    } else {
+                        ElMessage.success(`自动对齐完成！共处理 ${job.completed} 个未对齐需求点`);
                     }
+                } else if (job.status === 'cancelled') {
+                    ElMessage.info(`自动对齐已取消，已处理 ${job.completed}/${job.total} 个需求点`);
+                } else if (job.status === 'failed') {
+                    ElMessage.error(`自动对齐失败: ${job.error}`);
                 }
-
-                console.log(`为需求点添加代码对齐: ${requirement.name}`);
             } catch (error) {
-                console.error(`为需求点 ${requirement.name} 添加代码对齐失败:`, error);
-                throw error;
+                console.error('获取自动对齐进度失败:', error);
+                isAutoAligning.value = false;
             }
         };
 
@@ -1022,6 +929,8 @@ const app = createApp({
         onMounted(async () => {
             await fetchProjectMetadata();
             await fetchIssues();
+            // 页面刷新后重新接入服务端仍在运行的对齐任务
+            await pollAlignmentJob();
         });
 
         /***********************
@@ -1057,6 +966,7 @@ const app = createApp({
             deleteAlignment,
             // 自动对齐功能
             startAutoAlignment,
+            cancelAutoAlignment,
             isAutoAligning,
             alignmentProgress,
             // 统计数据
@@ -716,6 +716,27 @@ const app = createApp({
     }
 
 
+    /**
+     * 请求流式审查接口（SSE 解析见 event-stream.js）
+     * @param {string} url - 接口地址
+     * @param {Object} body - 请求体
+     * @param {Function} onEvent - 每收到一个事件时调用 (event, data)
+     * @returns {Promise<Object>} result 事件的数据；收到 error 事件时抛出异常
+     */
+    async function postReviewStream(url, body, onEvent) {
+      let result = null;
+      await postEventStream(url, body, (event, payload) => {
+        if (event === 'error') throw new Error(payload.message);
+        if (event === 'result') result = payload;
+        onEvent(event, payload);
+      });
+
+      if (!result) {
+        throw new Error('审查结果不完整');
+      }
+      return result;
+    }
+
     /**
      * 处理开始审查按钮点击事件
      * @returns
@@ -742,13 +763,19 @@ const app = createApp({
 
       isReviewing.value = true; // Set reviewing state
       try {
-        // Send the selected requirement block to the backend
-        const response = await axios.post('/api/review-consistency', { requirement: point.text, relatedCode: point.relatedCode });
+        // Send the selected requirement block to the backend, streaming the review text as it is generated
+        let streamedText = '';
+        const result = await postReviewStream('/api/review-consistency/stream', { requirement: point.text, relatedCode: point.relatedCode }, (event, data) => {
+          if (event === 'token') {
+            streamedText += data.content;
+            point.reviewProcess = renderMarkdownWithLatex(streamedText);
+          }
+        });
 
-        point.reviewProcess = renderMarkdownWithLatex(response.data.reviewProcess);
+        point.reviewProcess = renderMarkdownWithLatex(result.reviewProcess);
 
         let prefix = "在需求文档《" + requirementFilename.value.split('.')[0] + "》中：\n";
-        point.issues = prefix + response.data.issues;
+        point.issues = prefix + result.issues;
         point.state = '未导出';
 
         ElMessage({
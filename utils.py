@@ -1,10 +1,21 @@
 import os
+import ast
 import markdown
 from bs4 import BeautifulSoup
 import re
+import bisect
+import hashlib
+import itertools
+import functools
+import threading
+from collections import OrderedDict
 import tiktoken
 from doc2md import docToMd
 
+# token 计数使用的编码，以及按文件内容哈希缓存逐行 token 数的文件数上限
+TOKEN_ENCODING = "cl100k_base"
+TOKEN_CACHE_FILES = int(os.environ.get("TOKEN_CACHE_FILES", 2048))
+
 def count_lines_of_code(filepath):
     """一个简单的代码行数统计函数，忽略空行"""
     try:
@@ -100,7 +111,7 @@ def split_code(filename, content, max_length=10000):
     优化后的代码分块函数：
     1. 在分块前为每行代码添加行号
     2. 尽可能填充每个块直到接近最大长度
-    3. 不拆分完整代码结构（函数/类等）
+    3. 不拆分完整代码结构（函数/类等，按文件扩展名选择 C/C++、Java、JavaScript 或 Python 的结构解析器）
     4. 保持行完整性
     
     参数:
@@ -114,16 +125,22 @@ def split_code(filename, content, max_length=10000):
         - start_line: 起始行号
         - end_line: 结束行号
         - content: 块内容
+        - hash: 代码内容哈希（不含行号），用于增量对齐时判断分块是否变化
     """
     # 添加行号到每行代码
     lines = content.splitlines(keepends=True)
     numbered_lines = [f"{i + 1}: {line}" for i, line in enumerate(lines)]
     
-    encoder = tiktoken.get_encoding("cl100k_base")
-    line_token_counts = [estimate_tokens(encoder, line) for line in numbered_lines]
+    line_token_counts = numbered_line_tokens(content)
+    token_prefix = [0] + list(itertools.accumulate(line_token_counts))
+    total_lines = len(line_token_counts)
     
-    # 识别完整代码结构
-    protected_blocks = identify_protected_blocks(content)
+    # 识别完整代码结构：取结构树中尽量外层、且不超出预算的结构（函数始终完整保留）
+    protected_blocks = merge_outermost_blocks(select_protected_spans(
+        get_structure_parser(filename)(content),
+        lambda start, end: token_prefix[min(end, total_lines)] - token_prefix[min(start, total_lines + 1) - 1],
+        max_length
+    ))
     
     chunks = []
     current_chunk = []
@@ -149,6 +166,7 @@ def split_code(filename, content, max_length=10000):
             if not current_chunk:
                 chunks.append(create_chunk(filename, block_start, block_end, block_lines))
                 i = block_end
+                current_start = block_end
                 continue
             
             # 情况1b：添加受保护块会超出限制，先提交当前块
@@ -185,63 +203,689 @@ def split_code(filename, content, max_length=10000):
     
     return chunks
 
-def identify_protected_blocks(content):
-    """识别需要保护的代码块范围（起始行，结束行）"""
-    blocks = []
+def pack_code_files(code_files, max_tokens=10000):
+    """
+    按 token 预算打包代码文件，减少对齐请求次数：
+    1. 小文件整体打包（附带文件名），同一提示词中尽量装满 max_tokens
+    2. 超出预算的大文件按完整代码结构（split_code）拆分
+    3. 多个文件打包在一起时使用连续的全局行号，并记录各段与原文件行号的对应关系
     
-    # 函数定义
-    for match in re.finditer(r'\b[\w:<>]+\s+\w+\s*\([^)]*\)\s*\{', content):
-        start_line = content[:match.start()].count('\n') + 1
-        end_line = find_matching_brace(content, match.end()-1)
-        if end_line > 0:
-            blocks.append((start_line, end_line))
+    参数:
+        code_files: 代码文件列表，每个文件包含 name 和 content（原始代码）
+        max_tokens: 每个打包块的最大token数
+        
+    返回:
+        打包块列表，每个元素包含:
+        - name: 文件名（多文件时为逗号分隔的文件名）
+        - numberedContent: 带行号的内容
+        - segments: 仅多文件打包块包含，各文件片段的信息
+          {"name", "numberedContent"（原行号）, "start", "end"（全局行号范围）, "first_line"（原起始行号）}
+    """
+    return pack_code_units(split_code_units(code_files, max_tokens), max_tokens)
+
+
+def split_code_units(code_files, max_tokens=10000):
+    """
+    将代码文件拆分为打包单元：小文件为整体，大文件按代码结构拆分
+
+    返回:
+        单元列表，每个元素包含 name、lines（原始代码行）、first_line（原起始行号）、
+        tokens（带行号内容的token数）、hash（文件名与代码内容的哈希，与行号无关）
+    """
+    units = []
+    for code_file in code_files:
+        name = code_file["name"]
+        lines = code_file["content"].splitlines()
+        if not lines:
+            continue
+        line_token_counts = numbered_line_tokens(code_file["content"])
+        token_count = sum(line_token_counts)
+        if token_count <= max_tokens:
+            units.append({
+                "name": name,
+                "lines": lines,
+                "first_line": 1,
+                "tokens": token_count,
+                "hash": hash_code_lines(name, lines)
+            })
+            continue
+        for chunk in split_code(name, code_file["content"], max_length=max_tokens):
+            unit_lines = lines[chunk["start_line"] - 1:chunk["end_line"]]
+            units.append({
+                "name": name,
+                "lines": unit_lines,
+                "first_line": chunk["start_line"],
+                "tokens": sum(line_token_counts[chunk["start_line"] - 1:chunk["end_line"]]),
+                "hash": hash_code_lines(name, unit_lines)
+            })
+    return units
+
+
+def pack_code_units(units, max_tokens=10000):
+    """按输入顺序将打包单元装箱，生成带行号的打包块"""
+    bins = []
+    current_bin = []
+    current_tokens = 0
+    for unit in units:
+        if current_bin and current_tokens + unit["tokens"] > max_tokens:
+            bins.append(current_bin)
+            current_bin = []
+            current_tokens = 0
+        current_bin.append(unit)
+        current_tokens += unit["tokens"]
+    if current_bin:
+        bins.append(current_bin)
+
+    return [create_packed_chunk(units_in_bin) for units_in_bin in bins]
+
+
+def hash_code_lines(filename, lines):
+    """代码片段的内容哈希：只与文件名和代码内容有关，片段整体移动（行号变化）时保持不变"""
+    payload = filename + "\0" + "\n".join(line.rstrip("\r\n") for line in lines)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def create_packed_chunk(units):
+    """将一组打包单元生成为带行号的打包块"""
+    # 合并同一文件中相邻的片段，使其保持原始行号
+    merged_units = []
+    for unit in units:
+        previous = merged_units[-1] if merged_units else None
+        if previous and previous["name"] == unit["name"] and \
+                previous["first_line"] + len(previous["lines"]) == unit["first_line"]:
+            previous["lines"] = previous["lines"] + unit["lines"]
+        else:
+            merged_units.append(dict(unit))
+    units = merged_units
+
+    if len(units) == 1:
+        unit = units[0]
+        return {
+            "name": unit["name"],
+            "numberedContent": "".join(
+                f"{unit['first_line'] + i}: {line}\n" for i, line in enumerate(unit["lines"])
+            )
+        }
+
+    parts = []
+    segments = []
+    global_line = 1
+    for unit in units:
+        parts.append(f"// ===== 文件: {unit['name']} =====\n")
+        parts.extend(f"{global_line + i}: {line}\n" for i, line in enumerate(unit["lines"]))
+        segments.append({
+            "name": unit["name"],
+            "numberedContent": "".join(
+                f"{unit['first_line'] + i}: {line}\n" for i, line in enumerate(unit["lines"])
+            ),
+            "start": global_line,
+            "end": global_line + len(unit["lines"]) - 1,
+            "first_line": unit["first_line"]
+        })
+        global_line += len(unit["lines"])
+
+    return {
+        "name": ", ".join(dict.fromkeys(unit["name"] for unit in units)),
+        "numberedContent": "".join(parts),
+        "segments": segments
+    }
+
+# 支持压缩（C 风格注释）的代码文件扩展名
+COMPACT_EXTENSIONS = ('.c', '.h', '.cc', '.cpp', '.cxx', '.hh', '.hpp', '.hxx', '.java', '.js', '.ts', '.cs')
+NUMBERED_LINE_PATTERN = re.compile(r'^(\d+): ?(.*)$')
+FILE_HEADER_PATTERN = re.compile(r'^// ===== 文件: (.*) =====$')
+
+
+def compact_code(content, filename=""):
+    """
+    压缩代码以节省提示词 token：去除注释和空行，合并连续空白
     
-    # 类/结构体定义
-    for match in re.finditer(r'\b(class|struct)\s+\w+\s*\{', content):
-        start_line = content[:match.start()].count('\n') + 1
-        end_line = find_matching_brace(content, match.end()-1)
-        if end_line > 0:
-            blocks.append((start_line, end_line))
+    带行号的行（"N: 代码"）保留原始行号，因此模型返回的行号区间仍指向源文件中的真实行；
+    打包块中的文件分隔行（// ===== 文件: xxx =====）原样保留，并据此判断各段的文件类型。
+    非 C 风格注释的文件（如 Python）原样保留。
     
-    # 命名空间
-    for match in re.finditer(r'\bnamespace\s+\w+\s*\{', content):
-        start_line = content[:match.start()].count('\n') + 1
-        end_line = find_matching_brace(content, match.end()-1)
-        if end_line > 0:
-            blocks.append((start_line, end_line))
+    参数:
+        content: 代码内容（可以带行号）
+        filename: 文件名，用于判断文件类型
+        
+    返回:
+        压缩后的代码内容
+    """
+    compacted = []
+    in_block_comment = False
+    compactable = filename.lower().endswith(COMPACT_EXTENSIONS)
+    for line in content.splitlines():
+        header = FILE_HEADER_PATTERN.match(line)
+        if header:
+            compactable = header.group(1).lower().endswith(COMPACT_EXTENSIONS)
+            in_block_comment = False
+            compacted.append(line)
+            continue
+        if not compactable:
+            compacted.append(line)
+            continue
+
+        numbered = NUMBERED_LINE_PATTERN.match(line)
+        code = numbered.group(2) if numbered else line
+        code, in_block_comment = strip_c_comments(code, in_block_comment)
+        code = " ".join(code.split())
+        if not code:
+            continue
+        compacted.append(f"{numbered.group(1)}: {code}" if numbered else code)
+    return "\n".join(compacted) + ("\n" if content.endswith("\n") else "")
+
+
+def strip_c_comments(line, in_block_comment=False):
+    """
+    去除一行代码中的 C 风格注释（跳过字符串和字符常量中的注释符号）
     
-    return blocks
+    返回:
+        (去除注释后的代码, 行尾是否仍处于块注释中)
+    """
+    result = []
+    i = 0
+    quote = None
+    while i < len(line):
+        if in_block_comment:
+            end = line.find("*/", i)
+            if end < 0:
+                return "".join(result), True
+            in_block_comment = False
+            i = end + 2
+            result.append(" ")
+            continue
+        char = line[i]
+        if quote:
+            result.append(char)
+            if char == "\\" and i + 1 < len(line):
+                result.append(line[i + 1])
+                i += 2
+                continue
+            if char == quote:
+                quote = None
+        elif char in ('"', "'"):
+            quote = char
+            result.append(char)
+        elif line.startswith("//", i):
+            break
+        elif line.startswith("/*", i):
+            in_block_comment = True
+            i += 2
+            continue
+        else:
+            result.append(char)
+        i += 1
+    return "".join(result), in_block_comment
+
+class LineIndex:
+    """
+    文件的行偏移索引：每个文件只构建一次，之后按字符位置二分查找行号，
+    避免每次都截取并扫描文件前缀（content[:pos].count('\\n')）
+    """
+
+    def __init__(self, content):
+        self.content = content
+        # 每行起始字符的位置
+        self.line_starts = [0] + [match.end() for match in re.finditer('\n', content)]
+
+    def line_of(self, pos):
+        """字符位置所在的行号（从 1 开始）"""
+        return bisect.bisect_right(self.line_starts, pos)
+
+
+# C/C++ 结构扫描的词法单元：注释、预处理行、字符串/字符字面量整体跳过，只关注花括号、分号和访问控制标签
+CODE_TOKEN_PATTERN = re.compile(r'''
+    (?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<preprocessor>^[ \t]*\#(?:\\\r?\n|[^\n])*)
+  | (?P<string>\b(?:u8|u|U|L)?R"(?P<delimiter>[^\s()\\]{0,16})\(.*?\)(?P=delimiter)"
+      | (?:\b(?:u8|u|U|L))?"(?:\\.|[^"\\\n])*"
+      | '(?:\\.|[^'\\\n])*')
+  | (?P<brace>[{}])
+  | (?P<semicolon>;|\b(?:public|protected|private)\s*:(?!:))
+''', re.VERBOSE | re.MULTILINE | re.DOTALL)
+
+# Java 的词法单元：没有预处理行，支持文本块（"""..."""）
+JAVA_TOKEN_PATTERN = re.compile(r'''
+    (?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<string>""".*?"""|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<brace>[{}])
+  | (?P<semicolon>;)
+''', re.VERBOSE | re.DOTALL)
+
+# JavaScript / TypeScript 的词法单元：没有预处理行，支持模板字符串和正则字面量
+# （正则字面量与除号的区分见 js_regex_allowed）
+JS_TOKEN_PATTERN = re.compile(r'''
+    (?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<string>`(?:\\.|[^`\\])*`|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<regex>/(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/[A-Za-z]*)
+  | (?P<brace>[{}])
+  | (?P<semicolon>;)
+''', re.VERBOSE | re.DOTALL)
+
+# 其后的 / 开始正则字面量而不是除号的关键字
+JS_REGEX_KEYWORDS = {'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void', 'throw', 'case', 'do',
+                     'else', 'yield', 'await'}
+
+# 基于花括号的语言：词法单元、定义类型的关键字、是否识别箭头函数 / function 表达式、是否有构造函数初始化列表
+BRACE_LANGUAGES = {
+    "c": {"tokens": CODE_TOKEN_PATTERN, "class_keywords": ('class', 'struct', 'union', 'enum'), "js_functions": False,
+          "ctor_initializers": True},
+    "java": {"tokens": JAVA_TOKEN_PATTERN, "class_keywords": ('class', 'interface', 'enum', 'record'),
+             "js_functions": False, "ctor_initializers": False},
+    "js": {"tokens": JS_TOKEN_PATTERN, "class_keywords": ('class', 'interface', 'enum'), "js_functions": True,
+           "ctor_initializers": False},
+}
+
+# 构造函数初始化列表中的花括号初始化：形如 Foo() : a(1), b{2}, c{ 的函数头，最后一个成员名后的 { 是表达式而不是函数体
+CTOR_INITIALIZER_PATTERN = re.compile(r'''
+    \)[^:;{}]*(?<!:):(?!:)\s*
+    (?:[\w:]+(?:<[^;{}]*?>)?\s*(?:\(\)|\{\})\s*(?:\.\.\.)?\s*,\s*)*
+    [\w:]+(?:<[^;{}]*?>)?\s*$
+''', re.VERBOSE)
+
+# 后面跟括号但不是函数定义的关键字
+NON_FUNCTION_KEYWORDS = {'if', 'for', 'while', 'switch', 'catch', 'do', 'else', 'return', 'sizeof', 'case',
+                         'new', 'delete', 'throw', 'goto', 'alignof', 'decltype', 'defined'}
+
+
+def js_regex_allowed(content, pos):
+    """
+    判断 JavaScript 代码中位置 pos 处的 / 是否开始正则字面量
+
+    前一个有效字符是运算符、左括号、逗号、花括号、分号等，前一个词是 return / typeof 等关键字，
+    或位于文件开头时为正则；标识符、数字、)、] 和字符串之后为除号。
+    """
+    i = pos - 1
+    while i >= 0 and content[i].isspace():
+        i -= 1
+    if i < 0:
+        return True
+    char = content[i]
+    if char in ')]"\'`':
+        return False
+    if char.isalnum() or char in '_$':
+        start = i
+        while start > 0 and (content[start - 1].isalnum() or content[start - 1] in '_$'):
+            start -= 1
+        return content[start:i + 1] in JS_REGEX_KEYWORDS
+    return True
+
+
+def collapse_parentheses(text):
+    """折叠括号内的内容，只保留结构：f(a, (b)) -> f()"""
+    while True:
+        collapsed = re.sub(r'\([^()]*\)', '()', text)
+        if collapsed == text:
+            return collapsed
+        text = collapsed
+
+
+def is_initializer_brace(header):
+    """判断左花括号是否为构造函数初始化列表中的花括号初始化（如 Foo() : x{0} 中 x 之后的 {）"""
+    return bool(CTOR_INITIALIZER_PATTERN.search(collapse_parentheses(" ".join(header.split()))))
+
+
+def classify_block_header(header, parent_kind=None, language="c"):
+    """
+    根据左花括号之前的代码（已去除注释和字符串内容）判断代码块类型
+
+    返回:
+        "namespace"（命名空间、extern "C"）、"class"（类/结构体/联合体/枚举）、"function" 或 None（其他代码块）
+    """
+    header = " ".join(header.split())
+    if not header:
+        return None
+    if re.match(r'(?:inline\s+)?namespace\b', header) or re.match(r'extern\s*""$', header):
+        return "namespace"
+
+    flat = re.sub(r'\boperator\s*(?:\(\)|[^\s(]+)', 'operator', collapse_parentheses(header))
+    config = BRACE_LANGUAGES[language]
+    if config["js_functions"] and parent_kind != "function" and (
+            re.search(r'=>\s*$', flat) or re.search(r'\bfunction\b\s*\*?\s*\w*\s*\(\)\s*$', flat)):
+        # const f = (a) => { / const f = function (a) {
+        return "function"
+    if '=' in flat:
+        # 初始化列表、赋值的 lambda 等
+        return None
+
+    keywords = "|".join(config["class_keywords"])
+    if '(' not in flat and re.search(rf'\b(?:{keywords})\b', flat):
+        return "class"
+    if parent_kind == "function":
+        return None
+
+    call = re.search(r'([A-Za-z_~][\w:~]*)\s*\(\)', flat)
+    if not call or call.group(1).split('::')[-1] in NON_FUNCTION_KEYWORDS:
+        return None
+    prefix = flat[:call.start()].strip()
+    if prefix:
+        if not re.search(r'[\w*&>]$', prefix) or prefix.split()[-1] in NON_FUNCTION_KEYWORDS:
+            return None
+    elif '::' not in call.group(1) and parent_kind != "class":
+        # 没有返回类型的调用（如宏）只在类中视为构造函数
+        return None
+    return "function"
+
+
+def parse_code_structure(content, line_index=None, language="c"):
+    """
+    单遍扫描基于花括号的代码（C/C++、Java、JavaScript，由 language 指定），生成命名空间/类/结构体/函数的嵌套结构树
+
+    注释、字符串/字符字面量和预处理行中的花括号不参与匹配；
+    if/for 等普通代码块不生成节点，其中的结构挂到最近的外层结构下；未闭合的结构被丢弃，其子结构上移。
+    构造函数初始化列表中的花括号初始化（如 Foo() : x{0}, y{1} {）属于函数头，不作为代码块。
+
+    返回:
+        根节点列表，每个节点为 {"kind", "start", "end", "children"}（起止为行号）
+    """
+    if line_index is None:
+        line_index = LineIndex(content)
+    roots = []
+    stack = []  # 每个未闭合的左花括号: (节点或 None, 其中结构所挂的列表, 所属结构的类型)
+    header_parts = []
+    header_pos = None
+    last_end = 0
+    config = BRACE_LANGUAGES[language]
+    init_depth = 0  # 正在跳过的花括号初始化的嵌套深度，其中的内容以 {} 计入函数头
+
+    tokens = config["tokens"]
+    pos = 0
+    while True:
+        match = tokens.search(content, pos)
+        if match is None:
+            break
+        if match.lastgroup == 'regex' and not js_regex_allowed(content, match.start()):
+            # 除号：只跳过这一个字符，其后的内容照常扫描
+            pos = match.start() + 1
+            continue
+        pos = match.end()
+        text = content[last_end:match.start()]
+        if text.strip() and not init_depth:
+            if header_pos is None:
+                header_pos = last_end + len(text) - len(text.lstrip())
+            header_parts.append(text)
+        last_end = match.end()
+
+        token = match.lastgroup
+        if token == 'regex':
+            token = 'string'
+        if init_depth:
+            if token == 'brace':
+                init_depth += 1 if match.group() == '{' else -1
+                if not init_depth:
+                    header_parts.append('{}')
+            continue
+        if token == 'string':
+            if header_pos is None:
+                header_pos = match.start()
+            header_parts.append('""')
+            continue
+        if token not in ('brace', 'semicolon'):
+            header_parts.append(' ')
+            continue
+
+        if match.group() == '{':
+            header = "".join(header_parts)
+            if config["ctor_initializers"] and is_initializer_brace(header):
+                init_depth = 1
+                continue
+            container, parent_kind = (stack[-1][1], stack[-1][2]) if stack else (roots, None)
+            kind = classify_block_header(header, parent_kind, language)
+            if kind:
+                start = line_index.line_of(header_pos if header_pos is not None else match.start())
+                node = {"kind": kind, "start": start, "end": None, "children": []}
+                container.append(node)
+                stack.append((node, node["children"], kind))
+            else:
+                stack.append((None, container, parent_kind))
+        elif match.group() == '}' and stack:
+            node = stack.pop()[0]
+            if node is not None:
+                node["end"] = line_index.line_of(match.start())
+        header_parts = []
+        header_pos = None
+
+    # 未闭合的结构：从内到外用其子结构替换自身
+    for i in range(len(stack) - 1, -1, -1):
+        node = stack[i][0]
+        if node is None:
+            continue
+        container = stack[i - 1][1] if i > 0 else roots
+        position = next(j for j, item in enumerate(container) if item is node)
+        container[position:position + 1] = node["children"]
+    return roots
+
+
+def parse_python_structure(content, line_index=None):
+    """
+    解析 Python 代码的类/函数结构（装饰器计入所属定义），存在语法错误时按缩进识别
+
+    返回:
+        与 parse_code_structure 相同格式的结构树，节点另含 signature_line（def/class 所在行）
+    """
+    try:
+        tree = ast.parse(content)
+    except (SyntaxError, ValueError):
+        return parse_python_structure_by_indent(content)
+
+    def convert(body):
+        nodes = []
+        for item in body:
+            if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                nodes.append({
+                    "kind": "class" if isinstance(item, ast.ClassDef) else "function",
+                    "start": min([item.lineno] + [decorator.lineno for decorator in item.decorator_list]),
+                    "end": item.end_lineno,
+                    "signature_line": item.lineno,
+                    "children": convert(item.body),
+                })
+            else:
+                # if/try/with 等语句中的定义挂到外层结构下
+                for field in ('body', 'orelse', 'finalbody', 'handlers'):
+                    nodes.extend(convert(getattr(item, field, None) or []))
+        return nodes
+
+    return convert(tree.body)
+
+
+PYTHON_DEFINITION_PATTERN = re.compile(r'^(\s*)(?:async\s+def|def|class)\b')
+
+
+def parse_python_structure_by_indent(content):
+    """按缩进识别 Python 的类/函数结构：定义一直延续到下一个缩进不大于它的非空、非注释行之前"""
+    lines = content.splitlines()
+    roots = []
+    stack = []  # (缩进, 节点)
+    last_code_line = 0
+    decorator_start = None
+    for line_num, line in enumerate(lines, start=1):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        indent = len(line) - len(line.lstrip())
+        while stack and indent <= stack[-1][0]:
+            stack.pop()[1]["end"] = last_code_line
+        if stripped.startswith('@'):
+            decorator_start = decorator_start or line_num
+        else:
+            if PYTHON_DEFINITION_PATTERN.match(line):
+                node = {"kind": "class" if stripped.startswith('class') else "function",
+                        "start": decorator_start or line_num, "end": line_num, "signature_line": line_num,
+                        "children": []}
+                (stack[-1][1]["children"] if stack else roots).append(node)
+                stack.append((indent, node))
+            decorator_start = None
+        last_code_line = line_num
+    for _, node in stack:
+        node["end"] = last_code_line
+    return roots
+
+
+# 代码结构解析器注册表：扩展名 -> 解析函数 (content, line_index) -> 结构树
+# split_code 按结构树决定分块边界，因此各语言只需注册解析器，产出的分块格式完全一致
+STRUCTURE_PARSERS = {}
+
+
+def register_structure_parser(extensions, parser):
+    """为一组文件扩展名注册代码结构解析器"""
+    for extension in extensions:
+        STRUCTURE_PARSERS[extension.lower()] = parser
+
+
+def get_structure_parser(filename):
+    """按文件扩展名选择代码结构解析器，未注册的扩展名按 C/C++ 处理"""
+    return STRUCTURE_PARSERS.get(os.path.splitext(filename)[1].lower(), parse_code_structure)
+
+
+register_structure_parser(('.c', '.h', '.cc', '.cpp', '.cxx', '.hh', '.hpp', '.hxx'), parse_code_structure)
+register_structure_parser(('.java',), functools.partial(parse_code_structure, language="java"))
+register_structure_parser(('.js', '.jsx', '.mjs', '.cjs', '.ts', '.tsx'), functools.partial(parse_code_structure, language="js"))
+register_structure_parser(('.py', '.pyw'), parse_python_structure)
+
+
+def iter_leaf_structures(nodes):
+    """遍历最内层的结构：没有内部结构的节点，以及函数（函数内部的结构不再展开）"""
+    for node in nodes:
+        if node["kind"] == "function" or not node["children"]:
+            yield node
+        else:
+            yield from iter_leaf_structures(node["children"])
+
+
+def select_protected_spans(nodes, span_tokens, max_length):
+    """
+    从结构树中选出分块时不可拆分的区间：命名空间/类超出预算时改为保护其内部的结构，
+    函数及没有内部结构的代码块整体保护
+    """
+    spans = []
+    for node in nodes:
+        if node["kind"] != "function" and node["children"] and span_tokens(node["start"], node["end"]) > max_length:
+            spans.extend(select_protected_spans(node["children"], span_tokens, max_length))
+        else:
+            spans.append((node["start"], node["end"]))
+    return spans
+
+def build_code_skeleton(content, max_line_length=160, filename=""):
+    """
+    生成代码骨架：最内层的函数/类/结构体只保留签名及其行号范围，函数体之外的声明语句逐行保留
+    
+    参数:
+        content: 代码内容
+        max_line_length: 每条骨架文本的最大长度
+        filename: 文件名，用于按扩展名选择代码结构解析器
+        
+    返回:
+        按行号排序的骨架条目列表，每个元素包含:
+        - start / end: 行号范围（函数体之外的语句 start == end）
+        - text: 签名或语句文本
+        - is_block: 是否为完整代码结构
+    """
+    lines = content.splitlines()
+    # 只保留最内层结构（函数整体作为一个结构），外层结构（命名空间等）的首行作为普通语句保留
+    leaf_blocks = sorted(set(
+        (node["start"], node["end"], node.get("signature_line", node["start"]))
+        for node in iter_leaf_structures(get_structure_parser(filename)(content))
+    ))
+    comment_prefixes = ('#',) if filename.lower().endswith(('.py', '.pyw')) else ('//', '/*', '*')
+
+    covered = [False] * (len(lines) + 2)
+    entries = []
+    for start, end, signature_line in leaf_blocks:
+        for line_num in range(start, end + 1):
+            covered[line_num] = True
+        signature = lines[signature_line - 1].strip().rstrip('{').strip() if signature_line <= len(lines) else ""
+        entries.append({"start": start, "end": end, "text": signature[:max_line_length], "is_block": True})
+
+    for line_num, line in enumerate(lines, start=1):
+        stripped = line.strip()
+        if covered[line_num] or not stripped or stripped in ('{', '}', '};'):
+            continue
+        if stripped.startswith(comment_prefixes):
+            continue
+        entries.append({"start": line_num, "end": line_num, "text": stripped[:max_line_length], "is_block": False})
+
+    entries.sort(key=lambda entry: entry["start"])
+    return entries
+
+def merge_outermost_blocks(blocks):
+    """
+    将受保护块整理为按起始行排序、互不重叠的最外层区间：
+    被其他块包含的内层块被丢弃，部分重叠（如同一行结束和开始）的块合并为一个区间
+    """
+    merged = []
+    for start, end in sorted(blocks):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
 
 def find_enclosing_block(line_num, blocks):
-    """检查行是否属于某个受保护块"""
-    for start, end in blocks:
-        if start <= line_num <= end:
-            return (start, end)
+    """
+    查找包含该行的最外层受保护块（二分查找）
+
+    参数:
+        blocks: merge_outermost_blocks 生成的有序、互不重叠的区间列表
+    """
+    i = bisect.bisect_right(blocks, (line_num, float('inf'))) - 1
+    if i >= 0 and blocks[i][0] <= line_num <= blocks[i][1]:
+        return blocks[i]
     return None
 
 def estimate_tokens(encoder, line):
     # return len(re.findall(r'\b\w+\b|[\{\}\(\)\[\];,<>]|\S', line))
-    return len(encoder.encode(line))
-
-def find_matching_brace(content, open_pos):
-    """找到匹配的闭括号行号"""
-    stack = 1
-    pos = open_pos + 1
-    while pos < len(content) and stack > 0:
-        if content[pos] == '{':
-            stack += 1
-        elif content[pos] == '}':
-            stack -= 1
-        pos += 1
-    return content[:pos].count('\n') + 1 if stack == 0 else -1
+    return len(encoder.encode_ordinary(line))
+
+_encoder = None
+_encoder_lock = threading.Lock()
+_line_token_cache = OrderedDict()
+_line_token_cache_lock = threading.Lock()
+
+def get_token_encoder():
+    """获取进程内共享的 tiktoken 编码器（首次使用时加载）"""
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                _encoder = tiktoken.get_encoding(TOKEN_ENCODING)
+    return _encoder
+
+def count_tokens_batch(texts):
+    """批量计算多段文本的 token 数（在 tiktoken 内部多线程编码，不经过 Python 逐段循环）"""
+    if not texts:
+        return []
+    return [len(tokens) for tokens in get_token_encoder().encode_ordinary_batch(texts)]
+
+def numbered_line_tokens(content):
+    """
+    文件每行加上行号（"N: "）后的 token 数
+
+    结果按文件内容哈希缓存（LRU），相同文件的重复对齐请求不再重新编码。
+    """
+    key = hashlib.sha1(content.encode('utf-8')).digest()
+    with _line_token_cache_lock:
+        counts = _line_token_cache.get(key)
+        if counts is not None:
+            _line_token_cache.move_to_end(key)
+            return counts
+
+    lines = content.splitlines(keepends=True)
+    counts = tuple(count_tokens_batch([f"{i + 1}: {line}" for i, line in enumerate(lines)]))
+    with _line_token_cache_lock:
+        _line_token_cache[key] = counts
+        while len(_line_token_cache) > TOKEN_CACHE_FILES:
+            _line_token_cache.popitem(last=False)
+    return counts
 
 def create_chunk(filename, start, end, lines):
-    """创建分块字典"""
+    """创建分块字典（hash 为去掉行号后的代码内容哈希）"""
     return {
         "filename": filename,
         "start_line": start,
         "end_line": end,
-        "content": "".join(lines)
+        "content": "".join(lines),
+        "hash": hash_code_lines(filename, [line.split(": ", 1)[1] for line in lines])
     }
     
 